@@ -142,8 +142,8 @@ class ChatService:
 
     def _format_local_files(self, files: list[dict[str, Any]]) -> str:
         """格式化会话文件列表（过滤内部文件）"""
-        # 过滤掉内部文件（如 session.duckdb）
-        internal_files = {"session.duckdb"}
+        # 过滤掉内部文件（如 session.duckdb 及其 WAL）
+        internal_files = {"session.duckdb", "session.duckdb.wal"}
         user_files = [f for f in files if f.get("name", "") not in internal_files]
 
         if not user_files:
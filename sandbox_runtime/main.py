@@ -12,19 +12,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import subprocess
+import asyncio
+import datetime
+import decimal
+import functools
 import os
 import io
 import sys
 import logging
+import marshal
+import multiprocessing
+import re
+import secrets
+import shlex
+import shutil
+import stat
+import threading
+import time
 import traceback
-from contextlib import redirect_stdout, redirect_stderr
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, redirect_stdout, redirect_stderr
 from pathlib import Path
-from typing import Any
+from typing import Any, BinaryIO, NamedTuple
 
+import duckdb
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
 from fastapi import FastAPI, UploadFile, File, Query, HTTPException
 from fastapi.responses import FileResponse, JSONResponse
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -34,12 +53,61 @@ logger = logging.getLogger(__name__)
 
 SANDBOX_ROOT = Path("/app")
 
+# 会话根目录（字符串形式，拼接会话路径时无需逐段构造 Path）
+SESSIONS_ROOT = str(SANDBOX_ROOT / "sessions")
+
+# 会话根目录的真实路径，启动时解析一次，下载时无需重复 resolve
+SESSIONS_ROOT_REAL = os.path.realpath(SESSIONS_ROOT)
+
 # MinIO 配置（从环境变量读取）
 MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT", "localhost:9000")
 MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY", "admin")
 MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY", "admin123")
 MINIO_SECURE = os.getenv("MINIO_SECURE", "false").lower() == "true"
 
+# 单个请求的最长处理时间（秒），超时返回 504
+REQUEST_TIMEOUT = int(os.getenv("SANDBOX_REQUEST_TIMEOUT", "120"))
+
+# 不受请求超时限制的路径前缀（耗时取决于客户端传输速度）
+REQUEST_TIMEOUT_EXEMPT_PREFIXES = ("/upload", "/download/")
+
+# 单条 SQL 的最长执行时间（秒），超时由 DuckDB 中断查询
+SQL_TIMEOUT = int(os.getenv("SANDBOX_SQL_TIMEOUT", "60"))
+
+# 用户 Python 代码的最长执行时间（秒），超时强制结束子进程
+CODE_TIMEOUT = int(os.getenv("SANDBOX_CODE_TIMEOUT", "60"))
+
+# 每个 DuckDB 实例（共享内存库和每个缓存的会话库）的内存上限与线程数，
+# 多个会话库同时打开时避免各自按默认的 80% 物理内存申请导致 OOM，超出上限的中间结果溢写到磁盘
+DUCKDB_MEMORY_LIMIT = os.getenv("SANDBOX_DUCKDB_MEMORY_LIMIT", "2GB")
+DUCKDB_THREADS = int(os.getenv("SANDBOX_DUCKDB_THREADS", "4"))
+
+# Shell 命令 stdout/stderr 各自最多保留的字节数，超出部分截断
+MAX_COMMAND_OUTPUT_BYTES = 8 * 1024 * 1024
+
+# 需要 shell 解释的字符：管道、重定向、变量、通配符、子命令、注释、换行等
+SHELL_SYNTAX_CHARS = frozenset("|&;<>()$`\\*?[]{}~=!#\n")
+
+# 内核写文件时间戳使用的粗粒度时钟。time 模块未导出该常量，5 只是 Linux 上的时钟 ID；
+# 其他平台回退到 CLOCK_REALTIME，避免误读其他时钟
+CLOCK_REALTIME_COARSE = getattr(time, "CLOCK_REALTIME_COARSE", 5 if sys.platform == "linux" else time.CLOCK_REALTIME)
+
+# 会话内部文件（会话 DuckDB 及其 WAL），不属于用户代码生成的文件
+SESSION_INTERNAL_FILES = frozenset({"session.duckdb", "session.duckdb.wal"})
+
+# 流式读取 SQL 结果时每批的行数（也是结果 parquet 文件的 row group 大小）
+SQL_RESULT_BATCH_ROWS = 100_000
+
+# 上传/下载文件时每次读写的块大小
+FILE_CHUNK_SIZE = 1024 * 1024
+
+# 需要计算统计量的 DuckDB 数值类型（不含精度参数，如 DECIMAL(18,2) 按 DECIMAL 判断）
+NUMERIC_TYPES = frozenset({
+    "TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT",
+    "UTINYINT", "USMALLINT", "UINTEGER", "UBIGINT", "UHUGEINT",
+    "REAL", "DOUBLE", "FLOAT", "DECIMAL", "NUMERIC",
+})
+
 
 # ==================== DuckDB 连接管理器 ====================
 
@@ -47,75 +115,251 @@ MINIO_SECURE = os.getenv("MINIO_SECURE", "false").lower() == "true"
 class DuckDBConnectionManager:
     """
     DuckDB 连接管理器
-    - 启动时预加载 httpfs 扩展
-    - 提供配置好 S3 访问的连接
+    - 启动时创建共享内存数据库并预加载 httpfs 扩展
+    - 复用同一个内存数据库，按需派生配置好 S3 访问的游标连接
     """
 
     def __init__(self):
         self._extensions_loaded = False
         self._extensions_dir = SANDBOX_ROOT / "duckdb_extensions"
         self._extensions_dir.mkdir(parents=True, exist_ok=True)
+        self._base_conn = None
+        self._lock = threading.Lock()
+        # 是否可用 excel 扩展的 read_xlsx（比 spatial/GDAL 的 st_read 轻量得多）
+        self.has_native_xlsx = False
+        # 启动时已安装到扩展目录的扩展，会话连接上只需 LOAD
+        self.installed_extensions: set[str] = set()
 
     def preload_extensions(self) -> None:
         """预加载 DuckDB 扩展（启动时调用）"""
         if self._extensions_loaded:
             return
 
-        import duckdb
-
         logger.info("预加载 DuckDB 扩展...")
         try:
-            conn = duckdb.connect(":memory:")
-            conn.execute(f"SET extension_directory='{self._extensions_dir}';")
-            # 预安装常用扩展
+            # 直接在共享内存数据库上安装并加载，之后派生的游标无需再次初始化
+            conn = self._get_base_connection()
             conn.execute("INSTALL httpfs;")
-            conn.close()
+            configure_s3_access(conn)
+            self.installed_extensions.add("httpfs")
+            self.has_native_xlsx = self._probe_native_xlsx(conn)
+            if self.has_native_xlsx:
+                self.installed_extensions.add("excel")
+
+            # 会话初始化 ATTACH 外部数据库/读取 Excel 所需的扩展，逐个安装，单个失败不影响其他扩展
+            extensions = ["postgres", "mysql"]
+            if not self.has_native_xlsx:
+                extensions.append("spatial")
+            for name in extensions:
+                try:
+                    conn.execute(f"INSTALL {name};")
+                    self.installed_extensions.add(name)
+                except Exception as e:
+                    logger.warning(f"预安装 DuckDB 扩展 {name} 失败，将在首次使用时安装: {e}")
+
             self._extensions_loaded = True
             logger.info("DuckDB 扩展预加载完成")
         except Exception as e:
             logger.warning(f"预加载 DuckDB 扩展失败: {e}")
 
-    def get_connection(self, with_s3: bool = False):
+    @staticmethod
+    def _probe_native_xlsx(conn) -> bool:
+        """检测 excel 扩展的 read_xlsx 是否可用"""
+        try:
+            conn.execute("INSTALL excel; LOAD excel;")
+            return (
+                conn.execute("SELECT 1 FROM duckdb_functions() WHERE function_name = 'read_xlsx'").fetchone()
+                is not None
+            )
+        except Exception as e:
+            logger.info(f"read_xlsx 不可用，Excel 将回退到 spatial 扩展: {e}")
+            return False
+
+    def _get_base_connection(self):
+        """获取共享的内存数据库连接（首次调用时创建）"""
+        with self._lock:
+            if self._base_conn is None:
+                conn = duckdb.connect(":memory:")
+                conn.execute(f"SET extension_directory='{self._extensions_dir}';")
+                configure_duckdb_caches(conn)
+                # 内存库只用于文件的聚合统计，结果与行序无关；不保持插入顺序可让扫描和聚合更自由地并行。
+                # 会话库执行用户 SQL，需要保持无 ORDER BY 查询的结果顺序，不做此设置
+                conn.execute("SET GLOBAL preserve_insertion_order=false;")
+                self._base_conn = conn
+            return self._base_conn
+
+    def get_connection(self):
         """
         获取配置好的 DuckDB 连接
 
-        Args:
-            with_s3: 是否配置 S3 访问
+        返回共享内存数据库的游标：已加载的扩展、全局设置和 S3 SECRET 无需重复初始化，
+        TEMP VIEW 等连接级对象互相隔离，close() 只释放该游标。
 
         Returns:
             配置好的 DuckDB 连接
         """
-        import duckdb
+        return self._get_base_connection().cursor()
 
-        conn = duckdb.connect(":memory:")
-        conn.execute(f"SET extension_directory='{self._extensions_dir}';")
 
-        if with_s3:
-            configure_s3_access(conn)
+# 全局连接管理器实例
+duckdb_manager = DuckDBConnectionManager()
 
-        return conn
+# VIEW 元数据查询线程池（外部数据源的查询以网络 I/O 为主，可并发执行）
+inspect_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="duckdb-inspect")
 
 
-# 全局连接管理器实例
-duckdb_manager = DuckDBConnectionManager()
+def configure_duckdb_caches(conn) -> None:
+    """
+    开启 DuckDB 实例级的远程文件元数据缓存，并限制实例的内存与线程数。
+
+    数据源文件在 MinIO 中以 UUID 命名、写入后不再修改，缓存 HTTP 元数据（HEAD 请求）
+    和 Parquet footer 不会读到过期内容，重复扫描同一文件时可省去这些往返。
+    http_keep_alive/http_retries 默认已开启，无需设置；enable_object_cache 在当前版本已无作用。
+    """
+    conn.execute(
+        "SET GLOBAL enable_http_metadata_cache=true;"
+        "SET GLOBAL parquet_metadata_cache=true;"
+        f"SET GLOBAL memory_limit={quote_literal(DUCKDB_MEMORY_LIMIT)};"
+        f"SET GLOBAL threads={DUCKDB_THREADS};"
+    )
 
 
 def configure_s3_access(conn) -> None:
     """
-    配置 DuckDB 连接的 S3 (MinIO) 访问。
-    
-    在已有连接上配置 httpfs 扩展和 S3 认证信息。
-    适用于 session.duckdb 持久连接或需要访问 S3 的场景。
-    
+    配置 DuckDB 实例的 S3 (MinIO) 访问。
+
+    以临时 SECRET 注册 S3 认证信息：SECRET 保存在实例内存中、不写入数据库文件，
+    由该实例派生的所有游标共享，因此每个实例只需在创建时调用一次。
+    LOAD 与 CREATE SECRET 合并为一次 execute，省去逐条 SET 的往返和解析。
+
     Args:
         conn: DuckDB 连接实例
     """
-    conn.execute("LOAD httpfs;")
-    conn.execute(f"SET s3_endpoint='{MINIO_ENDPOINT}';")
-    conn.execute(f"SET s3_access_key_id='{MINIO_ACCESS_KEY}';")
-    conn.execute(f"SET s3_secret_access_key='{MINIO_SECRET_KEY}';")
-    conn.execute("SET s3_url_style='path';")
-    conn.execute(f"SET s3_use_ssl={'true' if MINIO_SECURE else 'false'};")
+    conn.execute(
+        "LOAD httpfs;"
+        "CREATE OR REPLACE SECRET minio ("
+        "TYPE S3, "
+        f"KEY_ID {quote_literal(MINIO_ACCESS_KEY)}, "
+        f"SECRET {quote_literal(MINIO_SECRET_KEY)}, "
+        f"ENDPOINT {quote_literal(MINIO_ENDPOINT)}, "
+        "URL_STYLE 'path', "
+        f"USE_SSL {'true' if MINIO_SECURE else 'false'}"
+        ");"
+    )
+
+
+class SessionConnectionCache:
+    """
+    会话 DuckDB 文件的连接缓存。
+
+    每个 session.duckdb 只打开一次读写连接，请求在其上派生游标执行查询，
+    避免每次请求都重新打开文件、回放 WAL 和加载 catalog。
+    同一进程内以不同配置（如 read_only）重复打开同一文件会失败，
+    因此所有访问会话 DuckDB 的处理函数都必须经由此缓存。
+
+    空闲超过 idle_ttl 的连接、超出容量时最久未使用的空闲连接会被关闭；重置会话时主动关闭。
+    """
+
+    def __init__(self, maxsize: int = 64, idle_ttl: float = 600.0):
+        self._maxsize = maxsize
+        self._idle_ttl = idle_ttl
+        # {路径: [连接, 最近使用时间, 使用中的游标数]}，按最近使用顺序排列
+        self._entries: dict[str, list] = {}
+        self._lock = threading.Lock()
+        # 冷启动按文件串行化：同一文件的连接共享数据库实例，并发执行初始化语句会产生 catalog 写冲突
+        self._open_locks = [threading.Lock() for _ in range(16)]
+
+    @staticmethod
+    def _connect(duckdb_path: Path) -> duckdb.DuckDBPyConnection:
+        conn = duckdb.connect(str(duckdb_path))
+        conn.execute(f"SET extension_directory='{SANDBOX_ROOT / 'duckdb_extensions'}';")
+        try:
+            configure_duckdb_caches(conn)
+            configure_s3_access(conn)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    @contextmanager
+    def cursor(self, duckdb_path: Path) -> Iterator[duckdb.DuckDBPyConnection]:
+        """获取会话连接上的新游标（不存在时创建连接），退出时关闭游标"""
+        key = str(duckdb_path)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._checkout_locked(key, entry)
+
+        if entry is None:
+            # 冷启动（回放 WAL、加载扩展）在全局锁外进行，避免阻塞其他会话
+            with self._open_locks[hash(key) % len(self._open_locks)]:
+                with self._lock:
+                    # 等待期间其他线程可能已打开同一文件
+                    entry = self._entries.pop(key, None)
+                    if entry is not None:
+                        self._checkout_locked(key, entry)
+                if entry is None:
+                    conn = self._connect(duckdb_path)
+                    entry = [conn, 0.0, 0]
+                    with self._lock:
+                        self._checkout_locked(key, entry)
+
+        try:
+            cursor = entry[0].cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+        finally:
+            with self._lock:
+                entry[1] = time.monotonic()
+                entry[2] -= 1
+                # 使用期间已被 close() 移出缓存的连接，由最后一个游标负责关闭
+                if not entry[2] and self._entries.get(key) is not entry:
+                    self._close_entry(key, entry)
+
+    def _checkout_locked(self, key: str, entry: list) -> None:
+        """登记一次游标使用并移到最近使用位置（调用方持有锁）"""
+        entry[1] = time.monotonic()
+        entry[2] += 1
+        self._entries[key] = entry
+        self._evict_locked()
+
+    def _evict_locked(self) -> None:
+        """关闭空闲过久的连接，并在超出容量时关闭最久未使用的空闲连接（调用方持有锁）"""
+        now = time.monotonic()
+        idle_keys = [key for key, (_, last_used, in_use) in self._entries.items() if not in_use]
+        expired = {key for key in idle_keys if now - self._entries[key][1] > self._idle_ttl}
+        overflow = len(self._entries) - len(expired) - self._maxsize
+        if overflow > 0:
+            expired.update([key for key in idle_keys if key not in expired][:overflow])
+        for key in expired:
+            self._close_entry(key, self._entries.pop(key))
+
+    @staticmethod
+    def _close_entry(key: str, entry: list) -> None:
+        try:
+            entry[0].close()
+        except Exception as e:
+            logger.warning(f"Failed to close session DuckDB connection {key}: {e}")
+
+    def close(self, directory: Path) -> None:
+        """
+        关闭指定目录（会话、用户或全部）下的连接，释放 session.duckdb 的文件锁。
+
+        删除会话文件前、以及运行可能自行打开会话 DuckDB 的用户代码或 shell 命令前调用。
+        仍有游标在使用的连接先移出缓存，待最后一个游标退出时关闭。
+        """
+        prefix = str(directory) + os.sep
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                entry = self._entries.pop(key)
+                if not entry[2]:
+                    self._close_entry(key, entry)
+
+
+# 全局会话连接缓存
+session_connections = SessionConnectionCache()
 
 
 # ==================== 请求/响应模型 ====================
@@ -145,6 +389,8 @@ class SqlRequest(BaseModel):
     """Request model for SQL execution."""
 
     sql: str
+    # 响应中最多返回的行数，完整结果始终保存在 result_file 中
+    max_rows: int = Field(10000, ge=0)
 
 
 class ChartRequest(BaseModel):
@@ -153,25 +399,6 @@ class ChartRequest(BaseModel):
     code: str
 
 
-class DataSourceInfo(BaseModel):
-    """数据源信息模型"""
-
-    source_type: str  # "file" 或 "database"
-
-    # 文件类型数据源 (source_type="file")
-    file_type: str | None = None  # csv, excel, json, parquet
-    object_key: str | None = None  # MinIO 对象 key
-    bucket_name: str | None = None  # MinIO bucket 名称
-
-    # 数据库类型数据源 (source_type="database")
-    db_type: str | None = None  # mysql, postgresql
-    host: str | None = None
-    port: int | None = None
-    database: str | None = None
-    username: str | None = None
-    password: str | None = None
-
-
 class QuickAnalysisRequest(BaseModel):
     """快速分析请求模型（新版：支持 VIEW 和文件）"""
 
@@ -248,85 +475,271 @@ class InitSessionRequest(BaseModel):
 # ==================== 辅助函数 ====================
 
 
+@functools.lru_cache(maxsize=4096)
 def get_session_dir(user_id: str, thread_id: str) -> Path:
     """
     获取会话工作目录。
 
     目录结构: /app/sessions/{user_id}/{thread_id}/
+    Path 不可变，按 (user_id, thread_id) 缓存，热点会话只需一次字典查找。
     """
-    session_dir = SANDBOX_ROOT / "sessions" / str(user_id) / str(thread_id)
-    return session_dir
+    return Path(os.path.join(SESSIONS_ROOT, str(user_id), str(thread_id)))
+
+
+def is_safe_path_segment(segment: str) -> bool:
+    """检查单个路径段是否安全：非空，不是 `.`/`..`，不含分隔符或 NUL"""
+    return bool(segment) and segment not in (".", "..") and not any(c in segment for c in "/\\\x00")
+
+
+def is_safe_relative_path(path: str) -> bool:
+    """检查以 `/` 分隔的相对路径是否安全（不访问文件系统）"""
+    return all(is_safe_path_segment(part) for part in path.split("/"))
+
+
+def resolve_session_path(user_id: str, thread_id: str, relative_path: str) -> str | None:
+    """
+    将会话目录下的相对路径解析为真实路径，路径不安全时返回 None。
+
+    先规范化（`./a.csv` 视为 `a.csv`）并按字符串拒绝 `..`、绝对路径等输入，再解析符号链接确认仍位于会话目录内。
+    会话根目录的真实路径在启动时已解析，只需对目标路径 realpath 一次，用 commonpath 判断，无需异常控制流程。
+    """
+    relative_path = os.path.normpath(relative_path)
+    if not (is_safe_path_segment(user_id) and is_safe_path_segment(thread_id) and is_safe_relative_path(relative_path)):
+        return None
+    session_real = os.path.join(SESSIONS_ROOT_REAL, user_id, thread_id)
+    full_path = os.path.realpath(os.path.join(session_real, relative_path))
+    if os.path.commonpath((session_real, full_path)) != session_real:
+        return None
+    return full_path
+
+
+# 已确认存在的会话目录，避免每个请求都执行 mkdir；重置操作删除目录时同步清除
+known_session_dirs: set[tuple[str, str]] = set()
+known_session_dirs_lock = threading.Lock()
 
 
 def ensure_session_dir(user_id: str, thread_id: str) -> Path:
     """
     确保会话目录存在，如果不存在则创建。
 
+    同一会话只在第一次调用时执行 mkdir。
+
     Returns:
         会话目录路径
     """
     session_dir = get_session_dir(user_id, thread_id)
-    session_dir.mkdir(parents=True, exist_ok=True)
+    key = (str(user_id), str(thread_id))
+    if key not in known_session_dirs:
+        session_dir.mkdir(parents=True, exist_ok=True)
+        with known_session_dirs_lock:
+            known_session_dirs.add(key)
     return session_dir
 
 
+def forget_session_dirs(user_id: str | None = None) -> None:
+    """
+    清除已创建会话目录的记录（目录被删除后调用）。
+
+    Args:
+        user_id: 只清除该用户的记录，为 None 时全部清除
+    """
+    with known_session_dirs_lock:
+        if user_id is None:
+            known_session_dirs.clear()
+        else:
+            known_session_dirs.difference_update({key for key in known_session_dirs if key[0] == str(user_id)})
+
+
 def generate_unique_filename(directory: Path, prefix: str, ext: str) -> str:
     """
-    生成唯一的文件名（4 个随机字母）。
-    
+    生成唯一的文件名（8 位随机十六进制字符），并以 O_EXCL 原子地创建空文件占位。
+
+    创建与检查是同一次系统调用，并发请求不会拿到同一个文件名；调用方随后直接覆盖写入该文件。
+
     Args:
         directory: 目标目录
         prefix: 文件名前缀（如 "sql_result_"）
         ext: 文件扩展名（如 ".parquet"）
-    
+
     Returns:
-        唯一的文件名（如 "sql_result_abcd.parquet"）
+        唯一的文件名（如 "sql_result_1a2b3c4d.parquet"）
     """
-    import random
-    import string
-    
-    for _ in range(100):  # 最多尝试 100 次
-        suffix = ''.join(random.choices(string.ascii_lowercase, k=4))
-        filename = f"{prefix}{suffix}{ext}"
-        if not (directory / filename).exists():
-            return filename
-    
-    # 如果 100 次都冲突，使用时间戳兜底
-    import time
-    return f"{prefix}{int(time.time())}{ext}"
+    for _ in range(8):  # 2^32 种组合，冲突几乎不可能，少量重试即可
+        filename = f"{prefix}{secrets.token_hex(4)}{ext}"
+        try:
+            fd = os.open(directory / filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            continue
+        os.close(fd)
+        return filename
+
+    raise FileExistsError(f"Failed to generate a unique filename in {directory}")
+
+
+def quote_identifier(name: str) -> str:
+    """将名称转义为 DuckDB 标识符（双引号包裹，内部双引号加倍）"""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def quote_literal(value: str) -> str:
+    """将字符串转义为 DuckDB 字符串字面量（单引号包裹，内部单引号加倍）"""
+    return "'" + value.replace("'", "''") + "'"
+
+
+# 写入目标为字符串字面量的语句：COPY ... TO '...'、EXPORT DATABASE '...'、ATTACH '...'
+SQL_WRITE_KEYWORDS = re.compile(r"\b(?:COPY|EXPORT|ATTACH)\b", re.IGNORECASE)
+SQL_STRING_LITERAL = r"'((?:[^']|'')*)'"
+SQL_WRITE_TARGET_PATTERNS = {
+    # COPY 的写入目标是最后一个 TO '...'（查询部分可能包含其他字符串）
+    duckdb.StatementType.COPY: re.compile(r"\bTO\s+" + SQL_STRING_LITERAL, re.IGNORECASE),
+    duckdb.StatementType.EXPORT: re.compile(
+        r"^\s*EXPORT\s+DATABASE\s+(?:\S+\s+TO\s+)?" + SQL_STRING_LITERAL, re.IGNORECASE
+    ),
+    duckdb.StatementType.ATTACH: re.compile(
+        r"^\s*ATTACH\s+(?:DATABASE\s+)?(?:IF\s+NOT\s+EXISTS\s+)?" + SQL_STRING_LITERAL, re.IGNORECASE
+    ),
+}
+
+
+def resolve_sql_write_paths(sql: str, session_dir: Path) -> str:
+    """
+    将 COPY ... TO、EXPORT DATABASE、ATTACH 中的相对路径改写为会话目录下的绝对路径。
+
+    file_search_path 只作用于读取，相对路径的写入目标会落在服务进程的工作目录中；
+    改写后无需切换进程级工作目录。绝对路径、URL（s3:// 等）、~ 开头的路径，
+    以及 ATTACH 外部数据库的连接字符串（含 =）保持不变。不含上述语句时不额外解析 SQL。
+    """
+    if not SQL_WRITE_KEYWORDS.search(sql):
+        return sql
+
+    pieces = []
+    copied = searched = 0
+    for statement in duckdb.extract_statements(sql):
+        pattern = SQL_WRITE_TARGET_PATTERNS.get(statement.type)
+        if pattern is None:
+            continue
+        start = sql.find(statement.query, searched)
+        matches = list(pattern.finditer(statement.query))
+        if start < 0 or not matches:
+            continue
+        searched = start + len(statement.query)
+
+        target = matches[-1]
+        path = target.group(1).replace("''", "'")
+        if not path or os.path.isabs(path) or path.startswith("~") or any(c in path for c in ":="):
+            continue
+        pieces.append(sql[copied:start + target.start(1) - 1])
+        pieces.append(quote_literal(os.path.join(session_dir, path)))
+        copied = start + target.end(1) + 1
+
+    if not pieces:
+        return sql
+    pieces.append(sql[copied:])
+    return "".join(pieces)
+
+
+def build_conninfo(db_type: str, **params: Any) -> str:
+    """
+    按 key=value 格式拼接 postgres/mysql 扩展 ATTACH 使用的连接字符串。
+
+    两个扩展的引号规则不同：
+    - postgresql：libpq 格式，值用单引号包裹，反斜杠和单引号以反斜杠转义
+    - mysql：mysql 扩展只识别双引号，值用双引号包裹，反斜杠和双引号以反斜杠转义
+
+    值为空或包含空白、引号、反斜杠时加引号，避免密码等字段中的特殊字符破坏解析；
+    值为 None 的参数省略，由扩展使用默认值。
+
+    Args:
+        db_type: 数据库类型（postgresql 或 mysql）
+        **params: 连接参数
+    """
+    quote = '"' if db_type == "mysql" else "'"
+    parts = []
+    for key, value in params.items():
+        if value is None:
+            continue
+        value = str(value)
+        if not value or any(c.isspace() or c in "'\"\\" for c in value):
+            value = quote + value.replace("\\", "\\\\").replace(quote, "\\" + quote) + quote
+        parts.append(f"{key}={value}")
+    return " ".join(parts)
+
+
+class FileEntry(NamedTuple):
+    """会话目录中的文件信息"""
+
+    name: str  # 相对于会话目录的路径
+    size: int
+    modified: float
+
+
+def load_extension(conn, name: str, loaded: set[str]) -> None:
+    """
+    在连接上加载 DuckDB 扩展，已加载的扩展直接跳过；启动时未能预安装的扩展先安装再加载。
+
+    Args:
+        conn: DuckDB 连接实例
+        name: 扩展名称
+        loaded: 该连接已加载的扩展集合（会被更新）
+    """
+    if name in loaded:
+        return
+    if name in duckdb_manager.installed_extensions:
+        conn.execute(f"LOAD {name};")
+    else:
+        conn.execute(f"INSTALL {name}; LOAD {name};")
+    loaded.add(name)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_user_code(code: str) -> bytes:
+    """
+    编译用户代码并缓存 marshal 序列化后的结果（子进程中 marshal.loads 后执行）。
+
+    重试或重复提交的相同代码直接复用序列化好的 code object，跳过词法分析、语法分析、编译和序列化。
+    文件名保持为 exec(str) 默认的 "<string>"，错误堆栈与之前一致。
+    """
+    return marshal.dumps(compile(code, "<string>", "exec"))
 
 
-def list_files_in_dir(directory: Path) -> list[dict[str, Any]]:
+def list_files_in_dir(directory: Path, changed_since_ns: int | None = None) -> list[FileEntry]:
     """
     列出目录中的所有文件（递归）。
 
+    返回轻量的 FileEntry 元组，只在需要返回 JSON 时才转换为 dict。
+    使用 os.scandir 迭代遍历：目录项自带文件类型，无需为每个条目构造 Path 和额外 stat。
+
+    Args:
+        directory: 要遍历的目录
+        changed_since_ns: 只返回 st_ctime 不早于该时间（纳秒）的文件，即此后创建、写入或移入的文件
+
     Returns:
         文件信息列表
     """
-    files = []
-    if not directory.exists():
-        return files
-
-    for path in directory.rglob("*"):
-        if path.is_file():
-            rel_path = path.relative_to(directory)
-            stat = path.stat()
-            files.append(
-                {
-                    "name": str(rel_path),
-                    "size": stat.st_size,
-                    "modified": stat.st_mtime,
-                }
-            )
+    files: list[FileEntry] = []
+    root = str(directory)
+    prefix_len = len(root) + 1
+    pending = [root]
+
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file():
+                        file_stat = entry.stat()
+                        if changed_since_ns is not None and file_stat.st_ctime_ns < changed_since_ns:
+                            continue
+                        files.append(FileEntry(entry.path[prefix_len:], file_stat.st_size, file_stat.st_mtime))
+        except FileNotFoundError:
+            continue  # 目录不存在或遍历期间被删除
     return files
 
 
 # ==================== 应用生命周期 ====================
 
 
-from contextlib import asynccontextmanager
-
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
@@ -337,7 +750,7 @@ async def lifespan(app: FastAPI):
     - 确保扩展目录存在
     
     Shutdown:
-    - 清理临时资源（如有）
+    - 关闭缓存的会话 DuckDB 连接
     """
     # ===== Startup =====
     logger.info("🚀 Sandbox Runtime 启动中...")
@@ -355,18 +768,114 @@ async def lifespan(app: FastAPI):
     
     # ===== Shutdown =====
     logger.info("🛑 Sandbox Runtime 关闭中...")
-    # 目前没有需要清理的资源
+    # 关闭缓存的会话 DuckDB 连接，确保 WAL 落盘
+    session_connections.close(sessions_dir)
     logger.info("👋 Sandbox Runtime 已关闭")
 
 
 # ==================== FastAPI App ====================
 
 
+def orjson_default(obj: Any) -> Any:
+    """
+    转换 orjson 无法原生序列化的值。
+
+    主要来自 DuckDB 查询结果的 Arrow to_pylist()：DECIMAL/HUGEINT（Decimal）、BLOB（bytes）等；
+    INTERVAL（pyarrow MonthDayNano）与 DuckDB 返回的 timedelta 一样输出总秒数（1 个月按 30 天计算），
+    而不是 [月, 天, 纳秒] 数组。
+    """
+    if isinstance(obj, decimal.Decimal):
+        # 整数值且在 64 位范围内时输出整数（orjson 不支持更大的整数）
+        if obj.as_tuple().exponent >= 0 and -(2**63) <= obj < 2**64:
+            return int(obj)
+        return float(obj)
+    # MonthDayNano 是 tuple 的子类，必须在 tuple 之前处理
+    if isinstance(obj, pa.MonthDayNano):
+        return (obj.months * 30 + obj.days) * 86400 + obj.nanoseconds / 1e9
+    if isinstance(obj, tuple):
+        return list(obj)
+    if isinstance(obj, datetime.timedelta):
+        return obj.total_seconds()
+    if isinstance(obj, bytes):
+        return obj.decode(errors="replace")
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+class ORJSONResponse(JSONResponse):
+    """
+    使用 orjson 序列化的 JSON 响应。
+
+    orjson 直接输出 bytes，序列化速度比标准库 json 快数倍，
+    对 /execute_sql 返回的大量行数据尤为明显。
+    """
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        )
+
+
+class LargeChunkFileResponse(FileResponse):
+    """以 1 MiB 块读取文件的 FileResponse（Starlette 默认 64 KiB），减少大文件下载时的读写次数"""
+
+    chunk_size = FILE_CHUNK_SIZE
+
+
+class RequestTimeoutMiddleware:
+    """
+    为每个请求设置整体超时的 ASGI 中间件，避免卡住的处理函数无限期占用 worker。
+
+    直接包裹下游应用，超时时取消处理函数并返回 504
+    （BaseHTTPMiddleware 在独立任务中运行处理函数，取消无法传递过去）。
+    响应已开始发送时无法再改写状态码，只能中断连接。
+    """
+
+    def __init__(self, app, timeout: float, exempt_prefixes: tuple[str, ...] = ()):
+        self.app = app
+        self.timeout = timeout
+        self.exempt_prefixes = exempt_prefixes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.exempt_prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        response_started = False
+
+        async def send_wrapper(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await asyncio.wait_for(self.app(scope, receive, send_wrapper), timeout=self.timeout)
+        except TimeoutError:
+            logger.warning(f"Request timeout ({self.timeout}s): {scope['method']} {scope['path']}")
+            if response_started:
+                raise
+            response = ORJSONResponse(
+                {"success": False, "error": f"Request timeout ({self.timeout}s)"},
+                status_code=504,
+            )
+            await response(scope, receive, send)
+
+
 app = FastAPI(
     title="Agentic Sandbox Runtime",
     description="An API server for executing commands and managing files in a secure sandbox.",
     version="2.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+
+app.add_middleware(
+    RequestTimeoutMiddleware,
+    timeout=REQUEST_TIMEOUT,
+    exempt_prefixes=REQUEST_TIMEOUT_EXEMPT_PREFIXES,
 )
 
 
@@ -382,19 +891,282 @@ async def health_check():
 # ==================== 会话初始化 ====================
 
 
+def count_view_rows(cursor, view_names: list[str]) -> dict[str, int] | None:
+    """
+    用一条 UNION ALL 查询统计所有 VIEW 的行数（在线程池中执行）。
+
+    Returns:
+        {view_name: row_count}；任一 VIEW 查询失败时返回 None，由调用方逐个统计
+    """
+    try:
+        if not view_names:
+            return {}
+        count_sql = " UNION ALL ".join(
+            f"SELECT {quote_literal(name)} AS view_name, COUNT(*) AS row_count FROM {quote_identifier(name)}"
+            for name in view_names
+        )
+        return dict(cursor.execute(count_sql).fetchall())
+    except Exception as e:
+        logger.info(f"Batched VIEW row count failed, falling back to per-view counts: {e}")
+        return None
+    finally:
+        cursor.close()
+
+
+class ViewColumnsCache:
+    """
+    会话 VIEW 列信息的 TTL 缓存。
+
+    以会话 DuckDB 文件（及其 WAL）的修改时间和大小作为版本号，
+    VIEW 变化导致文件变化时缓存自动失效；重置会话时主动清除。
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 60.0):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries: dict[str, tuple[tuple, float, dict[str, list[dict[str, str]]]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def file_version(duckdb_path: Path) -> tuple:
+        """返回 DuckDB 文件及其 WAL 的 (mtime, size) 版本号"""
+        version = []
+        for path in (duckdb_path, duckdb_path.with_name(duckdb_path.name + ".wal")):
+            try:
+                file_stat = path.stat()
+                version.append((file_stat.st_mtime_ns, file_stat.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def get(self, duckdb_path: Path, version: tuple) -> dict[str, list[dict[str, str]]] | None:
+        """获取未过期且版本一致的缓存，否则返回 None"""
+        key = str(duckdb_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            cached_version, expires_at, view_columns = entry
+            if cached_version != version or expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            return view_columns
+
+    def put(self, duckdb_path: Path, version: tuple, view_columns: dict[str, list[dict[str, str]]]) -> None:
+        """写入缓存，超出容量时淘汰最早写入的条目"""
+        with self._lock:
+            self._entries.pop(str(duckdb_path), None)
+            if len(self._entries) >= self._maxsize:
+                del self._entries[next(iter(self._entries))]
+            self._entries[str(duckdb_path)] = (version, time.monotonic() + self._ttl, view_columns)
+
+    def invalidate(self, directory: Path) -> None:
+        """清除指定目录（会话、用户或全部）下的缓存"""
+        prefix = str(directory) + os.sep
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+
+
+# 全局 VIEW 列信息缓存
+view_columns_cache = ViewColumnsCache()
+
+
+def fetch_view_columns(conn) -> dict[str, list[dict[str, str]]]:
+    """
+    用一条 information_schema 查询获取所有 VIEW 的列信息。
+
+    只读取 catalog 中保存的元数据，不会访问 VIEW 背后的文件或外部数据库。
+    VIEW 至少有一列，因此结果的键即为全部 VIEW 名称（按名称排序）。
+
+    Returns:
+        {view_name: [{"name", "dtype"}, ...]}
+    """
+    # 以列式 Arrow 表取回，避免为每一列元数据构造 DuckDB 结果元组
+    table = conn.execute(
+        """
+        SELECT c.table_name, c.column_name, c.data_type
+        FROM information_schema.columns c
+        JOIN information_schema.tables t USING (table_catalog, table_schema, table_name)
+        WHERE t.table_type = 'VIEW'
+          AND t.table_catalog = current_database()
+          AND t.table_schema = current_schema()
+        ORDER BY c.table_name, c.ordinal_position
+        """
+    ).to_arrow_table()
+
+    view_columns: dict[str, list[dict[str, str]]] = {}
+    for view_name, column_name, data_type in zip(*(column.to_pylist() for column in table.columns), strict=True):
+        view_columns.setdefault(view_name, []).append({"name": column_name, "dtype": data_type})
+    return view_columns
+
+
+def fetch_view_columns_by_pragma(conn, view_names: list[str]) -> dict[str, list[dict[str, str]]]:
+    """
+    用一条 pragma_table_info UNION ALL 查询批量获取指定 VIEW 的列信息。
+
+    information_schema 查询失败时使用，仍然只需一次解析和规划。
+
+    Returns:
+        {view_name: [{"name", "dtype"}, ...]}
+    """
+    pragma_sql = " UNION ALL ".join(
+        f"SELECT {quote_literal(name)} AS view_name, cid, name, type "
+        f"FROM pragma_table_info({quote_literal(quote_identifier(name))})"
+        for name in view_names
+    )
+    rows = conn.execute(f"SELECT view_name, name, type FROM ({pragma_sql}) ORDER BY view_name, cid").fetchall()
+
+    view_columns: dict[str, list[dict[str, str]]] = {}
+    for view_name, column_name, data_type in rows:
+        view_columns.setdefault(view_name, []).append({"name": column_name, "dtype": data_type})
+    return view_columns
+
+
+def inspect_view(
+    conn,
+    view_name: str,
+    row_counts: dict[str, int] | None = None,
+    view_columns: dict[str, list[dict[str, str]]] | None = None,
+    count_rows: bool = True,
+) -> dict[str, Any]:
+    """
+    获取单个 VIEW 的列信息和行数（在线程池中执行）。
+
+    批量查询已经拿到的信息直接使用，缺失的部分才在独立游标上逐个查询。
+
+    Args:
+        conn: 会话 DuckDB 连接
+        view_name: VIEW 名称
+        row_counts: 已批量统计好的行数，为 None 时单独执行 COUNT(*)
+        view_columns: 已批量查询好的列信息，为 None 时单独查询 information_schema
+        count_rows: 是否统计行数，为 False 时 row_count 返回 None
+    """
+    if (row_counts is not None or not count_rows) and view_columns and view_name in view_columns:
+        columns = view_columns[view_name]
+        return {
+            "name": view_name,
+            "columns": columns,
+            "column_count": len(columns),
+            "row_count": row_counts.get(view_name) if row_counts is not None else None,
+        }
+
+    cursor = conn.cursor()
+    try:
+        # 获取列信息：优先使用 catalog 元数据，不触及 VIEW 背后的数据
+        columns = view_columns.get(view_name) if view_columns else None
+        if not columns:
+            columns_meta = cursor.execute(
+                "SELECT column_name, data_type FROM information_schema.columns "
+                "WHERE table_catalog = current_database() AND table_schema = current_schema() "
+                "AND table_name = ? ORDER BY ordinal_position",
+                [view_name],
+            ).fetchall()
+            columns = [{"name": col[0], "dtype": col[1]} for col in columns_meta]
+        if not columns:
+            # 元数据缺失时才 DESCRIBE：直接描述 VIEW 本身，比 DESCRIBE SELECT 少一次完整的解析和规划
+            columns_meta = cursor.execute(f"DESCRIBE {quote_identifier(view_name)}").fetchall()
+            columns = [{"name": col[0], "dtype": col[1]} for col in columns_meta]
+
+        # 尝试获取行数（可能因为外部连接问题失败）
+        if not count_rows:
+            row_count = None
+        elif row_counts is not None:
+            row_count = row_counts.get(view_name)
+        else:
+            try:
+                row_count = cursor.execute(f"SELECT COUNT(*) FROM {quote_identifier(view_name)}").fetchone()[0]
+            except Exception:
+                row_count = None  # 外部数据源可能不可达
+
+        return {
+            "name": view_name,
+            "columns": columns,
+            "column_count": len(columns),
+            "row_count": row_count,
+        }
+    except Exception as e:
+        logger.warning(f"Failed to get info for view {view_name}: {e}")
+        return {
+            "name": view_name,
+            "error": str(e),
+        }
+    finally:
+        cursor.close()
+
+
+def list_session_views(duckdb_path: Path, include_row_counts: bool) -> list[dict[str, Any]]:
+    """
+    获取会话 DuckDB 中所有 VIEW 的列信息和行数（同步执行，通过 asyncio.to_thread 调用）。
+
+    Args:
+        duckdb_path: 会话 DuckDB 文件路径
+        include_row_counts: 是否统计行数
+    """
+    # 打开连接前记录文件版本，确保缓存的列信息不会比文件内容更新
+    file_version = ViewColumnsCache.file_version(duckdb_path)
+
+    with session_connections.cursor(duckdb_path) as conn:
+        # 一条查询同时获取所有 VIEW 的名称和列信息（命中缓存时跳过），失败时回退到逐个查询
+        view_columns = view_columns_cache.get(duckdb_path, file_version)
+        if view_columns is None:
+            try:
+                view_columns = fetch_view_columns(conn)
+                view_columns_cache.put(duckdb_path, file_version, view_columns)
+            except Exception as e:
+                logger.info(f"Batched VIEW column lookup failed, falling back to per-view lookup: {e}")
+                view_columns = None
+
+        if view_columns:
+            view_names = list(view_columns)
+        else:
+            # 查询所有 VIEW
+            views_result = conn.execute(
+                "SELECT table_name FROM information_schema.tables "
+                "WHERE table_type = 'VIEW' AND table_catalog = current_database() AND table_schema = current_schema() "
+                "ORDER BY table_name"
+            ).fetchall()
+            view_names = [view_name for (view_name,) in views_result]
+
+            # information_schema 不可用时，改用一条 pragma_table_info 批量查询，仍失败才逐个查询
+            if view_columns is None and view_names:
+                try:
+                    view_columns = fetch_view_columns_by_pragma(conn, view_names)
+                except Exception as e:
+                    logger.info(f"Batched pragma_table_info lookup failed, falling back to per-view lookup: {e}")
+
+        # 先用一条查询批量统计行数，失败时（如某个外部数据源不可达）回退到逐个统计
+        row_counts = count_view_rows(conn.cursor(), view_names) if include_row_counts else None
+
+        # 每个 VIEW 使用独立游标并发查询，总耗时取决于最慢的 VIEW 而非所有 VIEW 之和
+        return list(
+            inspect_executor.map(
+                functools.partial(
+                    inspect_view,
+                    conn,
+                    row_counts=row_counts,
+                    view_columns=view_columns,
+                    count_rows=include_row_counts,
+                ),
+                view_names,
+            )
+        )
+
+
 @app.get("/list_views", summary="List available VIEWs in session DuckDB")
 async def list_views(
     user_id: str = Query(..., description="User ID"),
     thread_id: str = Query(..., description="Thread/Session ID"),
+    include_row_counts: bool = Query(True, description="Whether to run COUNT(*) for each VIEW"),
 ):
     """
     列出会话 DuckDB 中所有可用的 VIEW。
     
     返回每个 VIEW 的名称、列信息和行数。
     用于让 AI 知道当前可以查询哪些数据。
+    只需要表结构时可传 include_row_counts=false，跳过耗时的 COUNT(*)，row_count 返回 null。
+    DuckDB 查询在工作线程中执行，不阻塞事件循环。
     """
-    import duckdb
-
     session_dir = get_session_dir(user_id, thread_id)
     duckdb_path = session_dir / "session.duckdb"
 
@@ -406,222 +1178,241 @@ async def list_views(
         }
 
     try:
-        conn = duckdb.connect(str(duckdb_path), read_only=True)
-
-        # 设置扩展目录
-        extensions_dir = SANDBOX_ROOT / "duckdb_extensions"
-        conn.execute(f"SET extension_directory='{extensions_dir}';")
+        views_info = await asyncio.to_thread(list_session_views, duckdb_path, include_row_counts)
+        return {
+            "success": True,
+            "views": views_info,
+            "view_count": len(views_info),
+        }
 
-        # 配置 S3 访问（VIEW 可能引用 S3 URL）
-        configure_s3_access(conn)
+    except Exception as e:
+        logger.exception(f"Failed to list views: {e}")
+        return {"success": False, "error": str(e), "views": []}
 
-        # 查询所有 VIEW
-        views_result = conn.execute(
-            "SELECT table_name FROM information_schema.tables WHERE table_type = 'VIEW'"
-        ).fetchall()
 
-        views_info = []
-        for (view_name,) in views_result:
-            try:
-                # 获取列信息
-                columns_meta = conn.execute(f'PRAGMA table_info("{view_name}")').fetchall()
-                columns = [{"name": col[1], "dtype": col[2]} for col in columns_meta]
+def build_unified_view_sql(
+    ds: DataSourceConfig, raw_id_to_name: dict[str, str], available_views: list[str]
+) -> str | None:
+    """
+    根据字段映射生成 DataSource 统一 VIEW 的 CREATE 语句。
 
-                # 尝试获取行数（可能因为外部连接问题失败）
-                try:
-                    row_count = conn.execute(f'SELECT COUNT(*) FROM "{view_name}"').fetchone()[0]
-                except Exception:
-                    row_count = None  # 外部数据源可能不可达
-
-                views_info.append({
-                    "name": view_name,
-                    "columns": columns,
-                    "column_count": len(columns),
-                    "row_count": row_count,
-                })
-            except Exception as e:
-                logger.warning(f"Failed to get info for view {view_name}: {e}")
-                views_info.append({
-                    "name": view_name,
-                    "error": str(e),
-                })
+    只合并 available_views 中已存在的 RawData VIEW；没有可合并的映射时返回 None。
+    """
+    if not (ds.raw_mappings and ds.target_fields and available_views):
+        return None
+
+    # 循环外一次性准备：可合并 VIEW 的集合（O(1) 成员判断）和目标字段名及其转义后的标识符
+    available = set(available_views)
+    target_fields = tuple((f["name"], quote_identifier(f["name"])) for f in ds.target_fields)
+
+    # 为每个有映射的 RawData 生成 SELECT 语句；映射相同的 RawData 共用同一个字段选择列表，只拼接一次
+    select_lists: dict[tuple[str | None, ...], str] = {}
+    select_parts: list[str] = []
+    for mapping in ds.raw_mappings:
+        raw_view_name = raw_id_to_name.get(mapping.raw_data_id)
+        if not raw_view_name or raw_view_name not in available:
+            continue
+
+        field_mappings = mapping.mappings
+        source_fields = tuple(field_mappings.get(target_field) or None for target_field, _ in target_fields)
+
+        select_list = select_lists.get(source_fields)
+        if select_list is None:
+            # 构建字段选择列表：有映射时 source_field AS target_field，无映射时 NULL AS target_field
+            select_list = select_lists[source_fields] = ", ".join(
+                f"{quote_identifier(source_field)} AS {target_ident}" if source_field else f"NULL AS {target_ident}"
+                for source_field, (_, target_ident) in zip(source_fields, target_fields, strict=True)
+            )
 
-        conn.close()
+        select_parts.append(f"SELECT {select_list} FROM {quote_identifier(raw_view_name)}")
 
-        return {
-            "success": True,
-            "views": views_info,
-            "view_count": len(views_info),
-        }
+    if not select_parts:
+        return None
 
-    except Exception as e:
-        logger.exception(f"Failed to list views: {e}")
-        return {"success": False, "error": str(e), "views": []}
+    # 使用 UNION ALL 合并多个 RawData 的映射视图
+    union_sql = " UNION ALL ".join(select_parts)
+    return f"CREATE OR REPLACE VIEW {quote_identifier(ds.name)} AS {union_sql}"
 
 
-@app.post("/init_session", summary="Initialize session DuckDB with data source")
-async def init_session(
-    request: InitSessionRequest,
-    user_id: str = Query(..., description="User ID (UUID string)"),
-    thread_id: str = Query(..., description="Thread/Session ID (UUID string)"),
-):
+def initialize_session_duckdb(request: InitSessionRequest, user_id: str, thread_id: str) -> dict[str, Any]:
     """
-    初始化会话的 DuckDB 文件。
+    初始化会话的 DuckDB 文件（同步执行，通过 asyncio.to_thread 调用）。
 
     创建一个持久化的 DuckDB 文件，并根据数据源配置：
     - 安装并加载必要的扩展 (postgres, mysql, httpfs)
     - ATTACH 外部数据库
     - 为每个 RawData 创建 VIEW
     """
-    import duckdb
-
     session_dir = ensure_session_dir(user_id, thread_id)
     duckdb_path = session_dir / "session.duckdb"
 
     try:
-        # 创建/打开 DuckDB 文件
-        conn = duckdb.connect(str(duckdb_path))
-
-        # 设置扩展目录
-        extensions_dir = SANDBOX_ROOT / "duckdb_extensions"
-        extensions_dir.mkdir(parents=True, exist_ok=True)
-        conn.execute(f"SET extension_directory='{extensions_dir}';")
+        # 创建/打开 DuckDB 文件（连接由会话连接缓存持有，ATTACH 的外部数据库在连接存活期间保持可用）
+        with session_connections.cursor(duckdb_path) as conn:
+            views_created: list[str] = []
+            errors: list[str] = []
+
+            # 如果没有数据源，只创建空的 DuckDB 文件
+            if not request.data_source:
+                return {
+                    "success": True,
+                    "message": "Session DuckDB initialized (no data source)",
+                    "duckdb_path": str(duckdb_path),
+                    "views_created": [],
+                    "errors": [],
+                }
 
-        views_created: list[str] = []
-        errors: list[str] = []
+            ds = request.data_source
 
-        # 如果没有数据源，只创建空的 DuckDB 文件
-        if not request.data_source:
-            conn.close()
-            return {
-                "success": True,
-                "message": "Session DuckDB initialized (no data source)",
-                "duckdb_path": str(duckdb_path),
-                "views_created": [],
-                "errors": [],
+            # 连接上已加载的扩展，避免每个 RawData 重复 INSTALL/LOAD
+            loaded_extensions = {
+                name for (name,) in conn.execute("SELECT extension_name FROM duckdb_extensions() WHERE loaded").fetchall()
             }
 
-        ds = request.data_source
+            # 构建 RawData ID 到 name 的映射
+            raw_id_to_name: dict[str, str] = {}
 
-        # 构建 RawData ID 到 name 的映射
-        raw_id_to_name: dict[str, str] = {}
+            # 待创建的原始 VIEW：(view_name, CREATE VIEW 语句)
+            raw_view_sqls: list[tuple[str, str]] = []
 
-        # Step 1: 为每个 RawData 创建原始 VIEW
-        for raw_data in ds.raw_data_list:
-            try:
-                view_name = raw_data.name  # 使用 RawData 名称作为 VIEW 名称
-                raw_id_to_name[raw_data.id] = view_name
-
-                if raw_data.raw_type == "database_table":
-                    # 数据库表类型：ATTACH 数据库并创建 VIEW
-                    if raw_data.db_type == "postgresql":
-                        conn.execute("INSTALL postgres; LOAD postgres;")
-                        conn_str = (
-                            f"host={raw_data.host} "
-                            f"port={raw_data.port} "
-                            f"dbname={raw_data.database} "
-                            f"user={raw_data.username} "
-                            f"password={raw_data.password}"
-                        )
-                        attach_name = f"pg_{raw_data.id}"
-                        conn.execute(f"ATTACH '{conn_str}' AS {attach_name} (TYPE POSTGRES, READ_ONLY);")
-
-                        # 构建源表名
-                        if raw_data.custom_sql:
-                            # 使用自定义 SQL
-                            conn.execute(f'CREATE OR REPLACE VIEW "{view_name}" AS {raw_data.custom_sql}')
-                        else:
-                            # 使用 schema.table
-                            schema = raw_data.schema_name or "public"
-                            table = raw_data.table_name
-                            conn.execute(f'CREATE OR REPLACE VIEW "{view_name}" AS SELECT * FROM {attach_name}.{schema}.{table}')
-
-                    elif raw_data.db_type == "mysql":
-                        conn.execute("INSTALL mysql; LOAD mysql;")
-                        conn_str = (
-                            f"host={raw_data.host} "
-                            f"port={raw_data.port} "
-                            f"database={raw_data.database} "
-                            f"user={raw_data.username} "
-                            f"password={raw_data.password}"
-                        )
-                        attach_name = f"mysql_{raw_data.id}"
-                        conn.execute(f"ATTACH '{conn_str}' AS {attach_name} (TYPE MYSQL, READ_ONLY);")
-
-                        if raw_data.custom_sql:
-                            conn.execute(f'CREATE OR REPLACE VIEW "{view_name}" AS {raw_data.custom_sql}')
+            # Step 1: 加载扩展、ATTACH 数据库，并为每个 RawData 生成 CREATE VIEW 语句
+            for raw_data in ds.raw_data_list:
+                try:
+                    view_name = raw_data.name  # 使用 RawData 名称作为 VIEW 名称
+                    raw_id_to_name[raw_data.id] = view_name
+                    view_ident = quote_identifier(view_name)
+
+                    if raw_data.raw_type == "database_table":
+                        # 数据库表类型：ATTACH 数据库并创建 VIEW
+                        if raw_data.db_type == "postgresql":
+                            load_extension(conn, "postgres", loaded_extensions)
+                            conn_str = build_conninfo(
+                                "postgresql",
+                                host=raw_data.host,
+                                port=raw_data.port,
+                                dbname=raw_data.database,
+                                user=raw_data.username,
+                                password=raw_data.password,
+                            )
+                            attach_name = quote_identifier(f"pg_{raw_data.id}")
+                            # 缓存的会话连接可能保留着上次初始化的 ATTACH，先解除再按新配置连接
+                            conn.execute(f"DETACH DATABASE IF EXISTS {attach_name};")
+                            conn.execute(f"ATTACH {quote_literal(conn_str)} AS {attach_name} (TYPE POSTGRES, READ_ONLY);")
+
+                            # 构建源表名
+                            if raw_data.custom_sql:
+                                # 使用自定义 SQL
+                                raw_view_sqls.append((view_name, f"CREATE OR REPLACE VIEW {view_ident} AS {raw_data.custom_sql}"))
+                            else:
+                                # 使用 schema.table
+                                schema = quote_identifier(raw_data.schema_name or "public")
+                                table = quote_identifier(raw_data.table_name)
+                                raw_view_sqls.append(
+                                    (view_name, f"CREATE OR REPLACE VIEW {view_ident} AS SELECT * FROM {attach_name}.{schema}.{table}")
+                                )
+
+                        elif raw_data.db_type == "mysql":
+                            load_extension(conn, "mysql", loaded_extensions)
+                            conn_str = build_conninfo(
+                                "mysql",
+                                host=raw_data.host,
+                                port=raw_data.port,
+                                database=raw_data.database,
+                                user=raw_data.username,
+                                password=raw_data.password,
+                            )
+                            attach_name = quote_identifier(f"mysql_{raw_data.id}")
+                            # 缓存的会话连接可能保留着上次初始化的 ATTACH，先解除再按新配置连接
+                            conn.execute(f"DETACH DATABASE IF EXISTS {attach_name};")
+                            conn.execute(f"ATTACH {quote_literal(conn_str)} AS {attach_name} (TYPE MYSQL, READ_ONLY);")
+
+                            if raw_data.custom_sql:
+                                raw_view_sqls.append((view_name, f"CREATE OR REPLACE VIEW {view_ident} AS {raw_data.custom_sql}"))
+                            else:
+                                table = quote_identifier(raw_data.table_name)
+                                raw_view_sqls.append(
+                                    (view_name, f"CREATE OR REPLACE VIEW {view_ident} AS SELECT * FROM {attach_name}.{table}")
+                                )
+
+                    elif raw_data.raw_type == "file":
+                        # 文件类型：通过 S3/httpfs 创建 VIEW
+                        # DuckDB 不支持在 CREATE VIEW 中绑定参数，因此标识符和字面量统一转义后拼接
+                        s3_url = quote_literal(f"s3://{raw_data.bucket_name}/{raw_data.object_key}")
+
+                        if raw_data.file_type == "csv":
+                            source_sql = f"read_csv_auto({s3_url}, header=True)"
+                        elif raw_data.file_type == "parquet":
+                            source_sql = f"parquet_scan({s3_url})"
+                        elif raw_data.file_type == "json":
+                            source_sql = f"read_json_auto({s3_url})"
+                        elif raw_data.file_type == "excel":
+                            if duckdb_manager.has_native_xlsx:
+                                load_extension(conn, "excel", loaded_extensions)
+                                source_sql = f"read_xlsx({s3_url})"
+                            else:
+                                load_extension(conn, "spatial", loaded_extensions)
+                                source_sql = f"st_read({s3_url})"
                         else:
-                            table = raw_data.table_name
-                            conn.execute(f'CREATE OR REPLACE VIEW "{view_name}" AS SELECT * FROM {attach_name}.{table}')
+                            source_sql = None
 
-                    views_created.append(view_name)
+                        if source_sql:
+                            raw_view_sqls.append((view_name, f"CREATE OR REPLACE VIEW {view_ident} AS SELECT * FROM {source_sql}"))
 
-                elif raw_data.raw_type == "file":
-                    # 文件类型：通过 S3/httpfs 创建 VIEW
-                    configure_s3_access(conn)
-
-                    s3_url = f"s3://{raw_data.bucket_name}/{raw_data.object_key}"
-
-                    if raw_data.file_type == "csv":
-                        conn.execute(f'CREATE OR REPLACE VIEW "{view_name}" AS SELECT * FROM read_csv_auto(\'{s3_url}\', header=True)')
-                    elif raw_data.file_type == "parquet":
-                        conn.execute(f'CREATE OR REPLACE VIEW "{view_name}" AS SELECT * FROM parquet_scan(\'{s3_url}\')')
-                    elif raw_data.file_type == "json":
-                        conn.execute(f'CREATE OR REPLACE VIEW "{view_name}" AS SELECT * FROM read_json_auto(\'{s3_url}\')')
-                    elif raw_data.file_type == "excel":
-                        conn.execute("INSTALL spatial; LOAD spatial;")
-                        conn.execute(f'CREATE OR REPLACE VIEW "{view_name}" AS SELECT * FROM st_read(\'{s3_url}\')')
-
-                    views_created.append(view_name)
-
-            except Exception as e:
-                error_msg = f"Failed to create view for {raw_data.name}: {str(e)}"
-                logger.warning(error_msg)
-                errors.append(error_msg)
+                except Exception as e:
+                    error_msg = f"Failed to create view for {raw_data.name}: {str(e)}"
+                    logger.warning(error_msg)
+                    errors.append(error_msg)
 
-        # Step 2: 如果有字段映射，创建 DataSource 级别的统一 VIEW
-        if ds.raw_mappings and ds.target_fields and views_created:
+            # Step 2: 如果有字段映射，生成 DataSource 级别的统一 VIEW
             try:
-                ds_view_name = ds.name  # DataSource 名称作为统一 VIEW 名称
-
-                # 获取目标字段名列表
-                target_field_names = [f["name"] for f in ds.target_fields]
-
-                # 为每个有映射的 RawData 生成 SELECT 语句
-                select_parts: list[str] = []
-                for mapping in ds.raw_mappings:
-                    raw_view_name = raw_id_to_name.get(mapping.raw_data_id)
-                    if not raw_view_name or raw_view_name not in views_created:
-                        continue
-
-                    # 构建字段选择列表：target_field AS source_field
-                    field_selects: list[str] = []
-                    for target_field in target_field_names:
-                        source_field = mapping.mappings.get(target_field)
-                        if source_field:
-                            # 有映射：使用 source_field AS target_field
-                            field_selects.append(f'"{source_field}" AS "{target_field}"')
-                        else:
-                            # 无映射：使用 NULL
-                            field_selects.append(f'NULL AS "{target_field}"')
-
-                    if field_selects:
-                        select_sql = f'SELECT {", ".join(field_selects)} FROM "{raw_view_name}"'
-                        select_parts.append(select_sql)
-
-                if select_parts:
-                    # 使用 UNION ALL 合并多个 RawData 的映射视图
-                    union_sql = " UNION ALL ".join(select_parts)
-                    conn.execute(f'CREATE OR REPLACE VIEW "{ds_view_name}" AS {union_sql}')
-                    views_created.append(ds_view_name)
-                    logger.info(f"Created DataSource unified VIEW: {ds_view_name}")
-
+                unified_sql = build_unified_view_sql(ds, raw_id_to_name, [name for name, _ in raw_view_sqls])
             except Exception as e:
+                unified_sql = None
                 error_msg = f"Failed to create DataSource unified view: {str(e)}"
                 logger.warning(error_msg)
                 errors.append(error_msg)
 
-        conn.close()
+            # Step 3: 在单个事务中批量创建所有 VIEW，只提交一次 catalog
+            statements = list(raw_view_sqls)
+            if unified_sql:
+                statements.append((ds.name, unified_sql))
+
+            try:
+                conn.execute("BEGIN TRANSACTION;")
+                for _, sql in statements:
+                    conn.execute(sql)
+                conn.execute("COMMIT;")
+                views_created.extend(name for name, _ in statements)
+            except Exception:
+                try:
+                    conn.execute("ROLLBACK;")
+                except Exception:
+                    pass  # 事务可能已被 DuckDB 自动回滚
+
+                # 批量创建失败：逐个创建以定位出错的 VIEW，其余 VIEW 照常可用
+                for view_name, sql in raw_view_sqls:
+                    try:
+                        conn.execute(sql)
+                        views_created.append(view_name)
+                    except Exception as e:
+                        error_msg = f"Failed to create view for {view_name}: {str(e)}"
+                        logger.warning(error_msg)
+                        errors.append(error_msg)
+
+                unified_sql = build_unified_view_sql(ds, raw_id_to_name, views_created)
+                if unified_sql:
+                    try:
+                        conn.execute(unified_sql)
+                        views_created.append(ds.name)
+                    except Exception as e:
+                        error_msg = f"Failed to create DataSource unified view: {str(e)}"
+                        logger.warning(error_msg)
+                        errors.append(error_msg)
+
+            if unified_sql and ds.name in views_created:
+                logger.info(f"Created DataSource unified VIEW: {ds.name}")
+
+        view_columns_cache.invalidate(session_dir)
 
         logger.info(f"Session DuckDB initialized: user_id={user_id}, thread_id={thread_id}, views={len(views_created)}")
 
@@ -634,16 +1425,63 @@ async def init_session(
         }
 
     except Exception as e:
-        import traceback
-
-        error_traceback = traceback.format_exc()
+        # 完整堆栈只记录在服务端日志中，响应只返回错误信息
         logger.exception(f"Failed to initialize session DuckDB: {e}")
-        return {"success": False, "error": f"{str(e)}\n\n{error_traceback}"}
+        return {"success": False, "error": str(e)}
+
+
+@app.post("/init_session", summary="Initialize session DuckDB with data source")
+async def init_session(
+    request: InitSessionRequest,
+    user_id: str = Query(..., description="User ID (UUID string)"),
+    thread_id: str = Query(..., description="Thread/Session ID (UUID string)"),
+):
+    """
+    初始化会话的 DuckDB 文件。
+
+    ATTACH 外部数据库、创建 VIEW 等操作在工作线程中执行，不阻塞事件循环。
+    """
+    return await asyncio.to_thread(initialize_session_duckdb, request, user_id, thread_id)
 
 
 # ==================== 重置操作 ====================
 
 
+def count_subdirectories(directory: Path) -> int:
+    """统计直接子目录数量（DirEntry 自带文件类型，无需逐个 stat 或构造 Path）"""
+    with os.scandir(directory) as entries:
+        return sum(1 for entry in entries if entry.is_dir(follow_symlinks=False))
+
+
+def remove_directory_tree(directory: Path) -> int:
+    """
+    删除目录及其全部内容，删除时顺便统计文件数（同步执行，通过 asyncio.to_thread 调用）。
+
+    只遍历一遍：文件在扫描时直接删除，目录在内容清空后自底向上删除；符号链接只删除链接本身。
+
+    Returns:
+        删除的文件数量
+    """
+    file_count = 0
+    pending = [str(directory)]
+    # 按访问顺序记录目录，父目录总在子目录之前，逆序即可自底向上删除
+    visited_dirs = []
+    while pending:
+        current = pending.pop()
+        visited_dirs.append(current)
+        with os.scandir(current) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                else:
+                    os.unlink(entry.path)
+                    file_count += 1
+
+    for path in reversed(visited_dirs):
+        os.rmdir(path)
+    return file_count
+
+
 @app.post("/reset/session", summary="Reset session files")
 async def reset_session(
     user_id: str = Query(..., description="User ID"),
@@ -653,8 +1491,6 @@ async def reset_session(
     重置指定会话的文件。
     删除该会话目录下的所有文件。
     """
-    import shutil
-
     session_dir = get_session_dir(user_id, thread_id)
 
     if not session_dir.exists():
@@ -665,12 +1501,10 @@ async def reset_session(
         }
 
     try:
-        # 统计文件数量
-        files = list_files_in_dir(session_dir)
-        deleted_count = len(files)
-
-        # 删除目录内容
-        shutil.rmtree(session_dir)
+        # 统计并删除目录内容（在工作线程中执行）
+        session_connections.close(session_dir)
+        deleted_count = await asyncio.to_thread(remove_directory_tree, session_dir)
+        view_columns_cache.invalidate(session_dir)
         session_dir.mkdir(parents=True, exist_ok=True)
 
         logger.info(f"Reset session: user_id={user_id}, thread_id={thread_id}, deleted={deleted_count} files")
@@ -693,8 +1527,6 @@ async def reset_user(
     重置指定用户的所有会话文件。
     删除该用户目录下的所有文件。
     """
-    import shutil
-
     user_dir = SANDBOX_ROOT / "sessions" / str(user_id)
 
     if not user_dir.exists():
@@ -706,15 +1538,14 @@ async def reset_user(
         }
 
     try:
-        # 统计会话和文件数量
-        session_count = len([d for d in user_dir.iterdir() if d.is_dir()])
-        file_count = 0
-        for session_dir in user_dir.iterdir():
-            if session_dir.is_dir():
-                file_count += len(list_files_in_dir(session_dir))
+        # 统计会话数量
+        session_count = count_subdirectories(user_dir)
 
-        # 删除用户目录
-        shutil.rmtree(user_dir)
+        # 统计并删除用户目录（在工作线程中执行）
+        session_connections.close(user_dir)
+        file_count = await asyncio.to_thread(remove_directory_tree, user_dir)
+        forget_session_dirs(user_id)
+        view_columns_cache.invalidate(user_dir)
 
         logger.info(f"Reset user: user_id={user_id}, deleted={file_count} files in {session_count} sessions")
 
@@ -736,8 +1567,6 @@ async def reset_all():
     删除 sessions 目录下的所有文件。
     仅用于管理目的，谨慎使用。
     """
-    import shutil
-
     sessions_dir = SANDBOX_ROOT / "sessions"
 
     if not sessions_dir.exists():
@@ -749,17 +1578,18 @@ async def reset_all():
         }
 
     try:
-        # 统计用户和文件数量
-        user_count = len([d for d in sessions_dir.iterdir() if d.is_dir()])
-        file_count = 0
-        for user_dir in sessions_dir.iterdir():
-            if user_dir.is_dir():
-                for session_dir in user_dir.iterdir():
-                    if session_dir.is_dir():
-                        file_count += len(list_files_in_dir(session_dir))
-
-        # 删除整个 sessions 目录并重建
-        shutil.rmtree(sessions_dir)
+        with os.scandir(sessions_dir) as entries:
+            user_dirs = [Path(entry.path) for entry in entries if entry.is_dir(follow_symlinks=False)]
+        user_count = len(user_dirs)
+
+        # 各用户目录在工作线程中并行删除并统计，最后删除 sessions 目录本身，随后重建
+        session_connections.close(sessions_dir)
+        user_file_counts = await asyncio.gather(
+            *(asyncio.to_thread(remove_directory_tree, user_dir) for user_dir in user_dirs)
+        )
+        file_count = sum(user_file_counts) + await asyncio.to_thread(remove_directory_tree, sessions_dir)
+        forget_session_dirs()
+        view_columns_cache.invalidate(sessions_dir)
         sessions_dir.mkdir(parents=True, exist_ok=True)
 
         logger.info(f"Reset all: deleted={file_count} files from {user_count} users")
@@ -782,21 +1612,42 @@ async def reset_all():
 async def list_files(
     user_id: str = Query(..., description="User ID"),
     thread_id: str = Query(..., description="Thread/Session ID"),
+    limit: int | None = Query(None, ge=0, description="Maximum number of files to return (all if omitted)"),
+    offset: int = Query(0, ge=0, description="Number of files to skip"),
 ):
     """
     列出会话目录中的所有文件。
     用于查看分析过程中生成的中间文件、图表、报告等。
+
+    目录遍历在工作线程中执行，不阻塞事件循环；文件很多时可用 limit/offset 分页，count 始终为文件总数。
     """
     session_dir = ensure_session_dir(user_id, thread_id)
-    files = list_files_in_dir(session_dir)
+    files = await asyncio.to_thread(list_files_in_dir, session_dir)
+
+    page = files
+    if limit is not None or offset:
+        # 分页时按名称排序，保证多次请求之间顺序一致
+        page = sorted(files, key=lambda f: f.name)
+        page = page[offset:] if limit is None else page[offset:offset + limit]
 
     return {
         "success": True,
-        "files": files,
+        "files": [{"name": f.name, "size": f.size, "modified": f.modified} for f in page],
         "count": len(files),
     }
 
 
+def save_upload(src: BinaryIO, file_path: Path) -> None:
+    """
+    将上传内容分块复制到目标文件（同步执行，通过 asyncio.to_thread 调用）。
+
+    整个复制在一个工作线程中完成，内存占用只有一个分块，也不必每个分块都在事件循环和线程池之间往返。
+    """
+    src.seek(0)
+    with open(file_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, FILE_CHUNK_SIZE)
+
+
 @app.post("/upload", summary="Upload a file to the session directory")
 async def upload_file(
     file: UploadFile = File(...),
@@ -814,13 +1665,12 @@ async def upload_file(
         # 确保父目录存在（处理带路径的文件名）
         file_path.parent.mkdir(parents=True, exist_ok=True)
 
-        with open(file_path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+        # 分块写入，大文件不会整体读入内存，磁盘写入也不阻塞事件循环
+        await asyncio.to_thread(save_upload, file.file, file_path)
 
         logger.info(f"File uploaded: {file_path}")
 
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=200,
             content={
                 "success": True,
@@ -830,7 +1680,7 @@ async def upload_file(
         )
     except Exception as e:
         logger.exception("File upload failed")
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500, content={"success": False, "message": f"Upload failed: {e!s}"}
         )
 
@@ -845,18 +1695,25 @@ async def download_file(
     从会话目录下载文件。
     file_path 是相对于会话目录的路径。
     """
-    session_dir = ensure_session_dir(user_id, thread_id)
-    full_path = session_dir / file_path
-
-    # 安全检查：防止路径穿越
-    try:
-        full_path.resolve().relative_to(session_dir.resolve())
-    except ValueError:
+    # 安全检查：防止路径穿越（含经由符号链接的穿越）
+    full_path = resolve_session_path(user_id, thread_id, file_path)
+    if full_path is None:
         raise HTTPException(status_code=403, detail="Access denied: path traversal detected")
 
-    if full_path.is_file():
-        return FileResponse(
-            path=str(full_path), media_type="application/octet-stream", filename=Path(file_path).name
+    ensure_session_dir(user_id, thread_id)
+
+    # 只 stat 一次：既用于判断是否为文件，也直接交给 FileResponse 设置 Content-Length 等响应头
+    try:
+        file_stat = os.stat(full_path)
+    except OSError:
+        file_stat = None
+
+    if file_stat is not None and stat.S_ISREG(file_stat.st_mode):
+        return LargeChunkFileResponse(
+            path=full_path,
+            media_type="application/octet-stream",
+            filename=os.path.basename(file_path),
+            stat_result=file_stat,
         )
 
     raise HTTPException(status_code=404, detail="File not found")
@@ -865,6 +1722,149 @@ async def download_file(
 # ==================== 代码执行 ====================
 
 
+# 用户代码在 forkserver 派生的子进程中执行：工作目录、sys.path 等进程级状态互不干扰，
+# 并发请求可以真正并行；forkserver 预加载本模块及用户代码常用的 pandas/plotly（导入约需 1 秒），
+# 子进程 fork 后直接继承，无需重复导入依赖
+user_code_mp_context = multiprocessing.get_context("forkserver")
+user_code_mp_context.set_forkserver_preload([__name__, "pandas", "plotly.express", "plotly.graph_objects"])
+
+
+def prepare_user_code_env(session_dir: str) -> dict[str, Any]:
+    """
+    在子进程中切换到会话目录，并返回用户代码的执行环境。
+
+    Args:
+        session_dir: 会话目录
+    """
+    os.chdir(session_dir)
+    sys.path.insert(0, session_dir)
+    return {
+        "__builtins__": __builtins__,
+        "__name__": "__main__",
+        "WORK_DIR": Path(session_dir),
+    }
+
+
+def format_user_code_error(e: BaseException) -> str:
+    """
+    格式化用户代码抛出的异常：错误信息加堆栈。
+
+    去掉沙盒自身（本文件）的栈帧，只保留用户代码（"<string>"）及其调用的库，
+    既能定位出错的代码行，也不会暴露服务端的文件路径。
+    """
+    tb = e.__traceback__
+    while tb is not None and tb.tb_frame.f_code.co_filename == __file__:
+        tb = tb.tb_next
+    return f"{e!s}\n\n{''.join(traceback.format_exception(type(e), e, tb))}"
+
+
+async def run_user_code_in_process(target, code: str, session_dir: Path) -> dict[str, Any]:
+    """
+    编译用户代码并在子进程中执行，返回子进程通过管道发送的结果。
+
+    在父进程中编译（命中缓存时无需重新编译），子进程只需反序列化 code object；
+    语法错误在启动子进程之前直接返回。超过 CODE_TIMEOUT 或请求被取消时强制结束子进程。
+
+    Args:
+        target: 子进程入口函数，签名为 (code_bytes, session_dir, result_conn)
+        code: 用户代码
+        session_dir: 会话目录
+    """
+    try:
+        code_bytes = compile_user_code(code)
+    except Exception as e:
+        return {
+            "success": False,
+            "output": "",
+            "error": format_user_code_error(e),
+        }
+
+    # 用户代码可能自行打开 session.duckdb，先释放缓存连接持有的文件锁
+    # （代价是之后的查询需要重新打开会话文件）
+    session_connections.close(session_dir)
+
+    parent_conn, child_conn = user_code_mp_context.Pipe(duplex=False)
+    process = user_code_mp_context.Process(target=target, args=(code_bytes, str(session_dir), child_conn))
+
+    try:
+        process.start()
+        # 关闭父进程持有的发送端，子进程异常退出时 recv() 才能收到 EOF
+        child_conn.close()
+
+        # 等待结果（子进程退出时 poll 也会因 EOF 返回），超时则强制结束子进程
+        if not await asyncio.to_thread(parent_conn.poll, CODE_TIMEOUT):
+            process.kill()
+            logger.warning(f"Code execution timeout ({CODE_TIMEOUT}s), killed pid {process.pid}")
+            return {
+                "success": False,
+                "output": "",
+                "error": f"Code execution timeout ({CODE_TIMEOUT}s)",
+            }
+
+        try:
+            return await asyncio.to_thread(parent_conn.recv)
+        except EOFError:
+            await asyncio.to_thread(process.join)
+            return {
+                "success": False,
+                "output": "",
+                "error": f"Code process exited unexpectedly (exit code {process.exitcode})",
+            }
+
+    except Exception as e:
+        logger.exception("Code process failed")
+        return {
+            "success": False,
+            "output": "",
+            "error": str(e),
+        }
+    finally:
+        if process.pid is not None:
+            # 请求被取消（如请求超时）时子进程可能仍在运行，先结束再回收
+            if process.is_alive():
+                process.kill()
+            await asyncio.to_thread(process.join)
+            process.close()
+        parent_conn.close()
+
+
+async def read_stream_bounded(stream: asyncio.StreamReader, limit: int = MAX_COMMAND_OUTPUT_BYTES) -> bytes:
+    """
+    读取子进程输出流，最多保留 limit 字节。
+
+    超出部分继续读取并丢弃（避免子进程因管道写满而阻塞），末尾追加截断标记。
+    """
+    buffer = bytearray()
+    truncated = False
+    while chunk := await stream.read(FILE_CHUNK_SIZE):
+        remaining = limit - len(buffer)
+        if remaining > 0:
+            buffer += chunk[:remaining]
+        if len(chunk) > remaining:
+            truncated = True
+    if truncated:
+        buffer += b"\n[output truncated]"
+    return bytes(buffer)
+
+
+def split_simple_command(command: str) -> list[str] | None:
+    """
+    将不含 shell 语法的简单命令拆分为参数列表，以便不经 /bin/sh 直接执行。
+
+    含 shell 语法、无法解析，或命令不是 PATH 中的可执行文件（如 cd、export 等 shell 内建命令）时返回 None，
+    由调用方回退到 shell 执行，保证行为与原先一致。
+    """
+    if not SHELL_SYNTAX_CHARS.isdisjoint(command):
+        return None
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        return None
+    if not args or shutil.which(args[0]) is None:
+        return None
+    return args
+
+
 @app.post("/execute", summary="Execute a shell command", response_model=ExecuteResponse)
 async def execute_command(
     request: ExecuteRequest,
@@ -878,25 +1878,96 @@ async def execute_command(
     try:
         session_dir = ensure_session_dir(user_id, thread_id)
 
-        # 使用 shell=True 以支持管道和重定向
-        process = subprocess.run(
-            request.command,
-            shell=True,
-            capture_output=True,
-            text=True,
-            cwd=str(session_dir),
-            timeout=60,
-        )
+        # 命令（如 duckdb CLI）可能打开 session.duckdb，先释放缓存连接持有的文件锁
+        # （代价是之后的查询需要重新打开会话文件）
+        session_connections.close(session_dir)
+
+        # 简单命令直接执行，省去启动 /bin/sh；含管道、重定向等语法时通过 shell 执行。
+        # 两种方式都异步等待子进程，不阻塞事件循环
+        args = split_simple_command(request.command)
+        if args is not None:
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=str(session_dir),
+            )
+        else:
+            process = await asyncio.create_subprocess_shell(
+                request.command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=str(session_dir),
+            )
+
+        try:
+            stdout, stderr, _ = await asyncio.wait_for(
+                asyncio.gather(
+                    read_stream_bounded(process.stdout),
+                    read_stream_bounded(process.stderr),
+                    process.wait(),
+                ),
+                timeout=60,
+            )
+        except TimeoutError:
+            process.kill()
+            await process.wait()
+            return ExecuteResponse(stdout="", stderr="Command execution timeout (60s)", exit_code=124)
 
         return ExecuteResponse(
-            stdout=process.stdout, stderr=process.stderr, exit_code=process.returncode
+            stdout=stdout.decode(errors="replace"),
+            stderr=stderr.decode(errors="replace"),
+            exit_code=process.returncode,
         )
-    except subprocess.TimeoutExpired:
-        return ExecuteResponse(stdout="", stderr="Command execution timeout (60s)", exit_code=124)
     except Exception as e:
         return ExecuteResponse(stdout="", stderr=f"Failed to execute command: {e!s}", exit_code=1)
 
 
+def run_python_code(code_bytes: bytes, session_dir: str, result_conn) -> None:
+    """
+    在子进程中执行 Python 代码，并通过管道返回结果。
+
+    Args:
+        code_bytes: 父进程编译并 marshal 序列化的 code object
+        session_dir: 会话目录，作为子进程的工作目录
+        result_conn: 用于发送结果的管道端
+    """
+    exec_globals = prepare_user_code_env(session_dir)
+
+    # 记录执行开始时间，执行后只需遍历一次目录即可找出新文件，无需执行前后各列一遍再求差集。
+    # 内核的文件时间戳取自粗粒度时钟，起点也取同一时钟，避免刚创建的文件时间戳早于起点
+    started_ns = time.clock_gettime_ns(CLOCK_REALTIME_COARSE)
+
+    # 捕获输出
+    stdout_buffer = io.StringIO()
+    stderr_buffer = io.StringIO()
+
+    try:
+        with redirect_stdout(stdout_buffer), redirect_stderr(stderr_buffer):
+            exec(marshal.loads(code_bytes), exec_globals)
+
+        # 获取执行期间创建或写入的文件（包括被覆盖的已有文件，会话内部文件除外）
+        result = {
+            "success": True,
+            "output": stdout_buffer.getvalue(),
+            "files_created": [
+                f.name
+                for f in list_files_in_dir(Path(session_dir), started_ns)
+                if f.name not in SESSION_INTERNAL_FILES
+            ],
+        }
+
+    except Exception as e:
+        result = {
+            "success": False,
+            "output": stdout_buffer.getvalue(),
+            "error": format_user_code_error(e),
+        }
+
+    result_conn.send(result)
+    result_conn.close()
+
+
 @app.post("/execute_python", summary="Execute Python code")
 async def execute_python(
     request: CodeRequest,
@@ -907,69 +1978,116 @@ async def execute_python(
     在沙盒中执行 Python 代码。
     代码可以访问 pandas、numpy 等数据分析库。
     生成的文件会保存到会话目录。
+    代码在独立子进程中执行，不阻塞事件循环，也不影响服务进程的状态。
     """
     session_dir = ensure_session_dir(user_id, thread_id)
+    result = await run_user_code_in_process(run_python_code, request.code, session_dir)
+    return CodeExecutionResult(**result)
 
-    # 获取执行前的文件列表
-    files_before = set(f["name"] for f in list_files_in_dir(session_dir))
 
-    # 捕获输出
-    stdout_buffer = io.StringIO()
-    stderr_buffer = io.StringIO()
+# Arrow month_day_nano_interval 的内存布局：月数、天数、纳秒数
+MONTH_DAY_NANO_DTYPE = np.dtype([("months", "<i4"), ("days", "<i4"), ("nanos", "<i8")])
 
-    # 准备执行环境
-    exec_globals = {
-        "__builtins__": __builtins__,
-        "__name__": "__main__",
-        "WORK_DIR": session_dir,
-    }
 
-    # 切换到会话目录
-    original_cwd = os.getcwd()
-    original_path = sys.path.copy()
+def interval_to_duration(array: pa.Array) -> pa.Array:
+    """
+    将 DuckDB INTERVAL 对应的 month_day_nano_interval 数组转换为 duration[us]（parquet 不支持前者）。
 
-    try:
-        os.chdir(session_dir)
-        sys.path.insert(0, str(session_dir))
+    换算规则与 DuckDB 转换为 Python timedelta 一致：1 个月按 30 天计算。
+    """
+    values = np.frombuffer(
+        array.buffers()[1],
+        dtype=MONTH_DAY_NANO_DTYPE,
+        count=len(array),
+        offset=array.offset * MONTH_DAY_NANO_DTYPE.itemsize,
+    )
+    micros = (values["months"].astype(np.int64) * 30 + values["days"]) * 86_400_000_000 + values["nanos"] // 1000
+    mask = array.is_null().to_numpy(zero_copy_only=False) if array.null_count else None
+    return pa.array(micros, type=pa.duration("us"), mask=mask)
+
+
+def stream_query_result(reader, session_dir: Path, max_rows: int) -> tuple[list[tuple], int, str | None]:
+    """
+    逐批读取查询结果：完整结果写入会话目录下的 parquet 文件，同时收集前 max_rows 行作为响应预览。
 
-        with redirect_stdout(stdout_buffer), redirect_stderr(stderr_buffer):
-            exec(request.code, exec_globals)
+    内存中只保留当前批次和预览行，不会一次性把整个结果集读入内存。
+    结果为空时不创建文件；写入失败时删除文件，但继续读取以统计总行数。
 
-        # 获取新创建的文件
-        files_after = set(f["name"] for f in list_files_in_dir(session_dir))
-        files_created = list(files_after - files_before)
+    Args:
+        reader: 查询结果的 pyarrow.RecordBatchReader
+        session_dir: 会话目录
+        max_rows: 预览的最大行数
 
-        return CodeExecutionResult(
-            success=True,
-            output=stdout_buffer.getvalue(),
-            files_created=files_created,
-        )
+    Returns:
+        (预览行, 结果总行数, 结果文件名)
+    """
+    # INTERVAL 列写入文件前转换为 duration，其余列原样写入
+    interval_columns = {i for i, field in enumerate(reader.schema) if pa.types.is_interval(field.type)}
+    file_schema = reader.schema
+    for i in interval_columns:
+        file_schema = file_schema.set(i, file_schema.field(i).with_type(pa.duration("us")))
+
+    rows: list[tuple] = []
+    total_rows = 0
+    result_path: Path | None = None
+    writer = None
+    save_failed = False
 
-    except Exception as e:
-        error_traceback = traceback.format_exc()
-        return CodeExecutionResult(
-            success=False,
-            output=stdout_buffer.getvalue(),
-            error=f"{e!s}\n\n{error_traceback}",
-        )
+    try:
+        for batch in reader:
+            if not batch.num_rows:
+                continue
+            total_rows += batch.num_rows
+
+            # 只把前 max_rows 行转换为 Python 对象
+            if len(rows) < max_rows:
+                preview = batch.slice(0, max_rows - len(rows))
+                # MAP 转换为 dict（默认是 (key, value) 元组列表），与 DuckDB fetchall() 的结果一致
+                rows.extend(zip(*(column.to_pylist(maps_as_pydicts="lossy") for column in preview.columns), strict=True))
+
+            if not save_failed:
+                try:
+                    if writer is None:
+                        result_path = session_dir / generate_unique_filename(session_dir, "sql_result_", ".parquet")
+                        # ZSTD 比默认的 snappy 压缩率更高，结果文件更小，下载和后续读取更快
+                        writer = pq.ParquetWriter(result_path, file_schema, compression="zstd")
+                    if interval_columns:
+                        batch = pa.RecordBatch.from_arrays(
+                            [
+                                interval_to_duration(column) if i in interval_columns else column
+                                for i, column in enumerate(batch.columns)
+                            ],
+                            schema=file_schema,
+                        )
+                    writer.write_batch(batch)
+                except Exception as e:
+                    logger.warning(f"Failed to save SQL result: {e}")
+                    save_failed = True
+    except BaseException:
+        # 查询失败或超时，不保留写了一半的文件
+        save_failed = True
+        raise
     finally:
-        os.chdir(original_cwd)
-        sys.path = original_path
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception as e:
+                logger.warning(f"Failed to save SQL result: {e}")
+                save_failed = True
+        # 删除占位或写了一半的文件，不返回不可用的结果文件
+        if result_path is not None and save_failed:
+            result_path.unlink(missing_ok=True)
+            result_path = None
 
+    return rows, total_rows, result_path.name if result_path is not None else None
 
-@app.post("/execute_sql", summary="Execute SQL query using DuckDB")
-async def execute_sql(
-    request: SqlRequest,
-    user_id: str = Query(..., description="User ID"),
-    thread_id: str = Query(..., description="Thread/Session ID"),
-):
+
+def run_sql_query(request: SqlRequest, user_id: str, thread_id: str) -> dict[str, Any] | ORJSONResponse:
     """
-    使用会话的 DuckDB 文件执行 SQL 查询。
+    使用会话的 DuckDB 文件执行 SQL 查询（同步执行，通过 asyncio.to_thread 调用）。
 
     数据通过会话初始化时创建的 VIEWs 访问，AI 可以直接查询这些 VIEWs。
     """
-    import duckdb
-
     session_dir = ensure_session_dir(user_id, thread_id)
     duckdb_path = session_dir / "session.duckdb"
 
@@ -978,161 +2096,244 @@ async def execute_sql(
         if not duckdb_path.exists():
             logger.warning(f"Session DuckDB not found, creating empty: {duckdb_path}")
 
-        # 打开会话的 DuckDB 文件
-        conn = duckdb.connect(str(duckdb_path))
+        # 在缓存的会话连接上派生游标，避免每次请求重新打开 DuckDB 文件
+        with session_connections.cursor(duckdb_path) as conn:
+            # 相对路径在会话目录下查找（流式读取结果时同样生效）
+            conn.execute(f"SET file_search_path={quote_literal(str(session_dir))};")
 
-        # 设置扩展目录
-        extensions_dir = SANDBOX_ROOT / "duckdb_extensions"
-        conn.execute(f"SET extension_directory='{extensions_dir}';")
+            # 超时后由 DuckDB 中断正在执行的查询。流式读取时中断表现为 Arrow 的 OSError
+            # 而不是 duckdb.InterruptException，因此用标志位判断是否超时
+            timed_out = threading.Event()
 
-        # 配置 S3 访问（用于读取会话目录中的临时文件）
-        configure_s3_access(conn)
+            def interrupt_query() -> None:
+                timed_out.set()
+                conn.interrupt()
 
-        # 切换工作目录以便相对路径访问本地文件
-        original_cwd = os.getcwd()
-        os.chdir(session_dir)
+            interrupt_timer = threading.Timer(SQL_TIMEOUT, interrupt_query)
+            interrupt_timer.daemon = True
+            interrupt_timer.start()
 
-        try:
-            # 先用 EXPLAIN 检查 SQL 语法（不实际执行）
             try:
-                conn.execute(f"EXPLAIN {request.sql}")
-            except Exception as explain_error:
-                # 语法错误，直接返回错误信息
-                error_msg = str(explain_error)
-                logger.warning(f"SQL syntax check failed: {error_msg}")
-                return {"success": False, "error": error_msg}
-
-            # 语法检查通过，执行实际查询
-            result = conn.execute(request.sql)
-            columns = [desc[0] for desc in result.description] if result.description else []
-            rows = result.fetchall()
-
-            # 自动保存结果到 parquet 文件（供后续工具使用）
-            result_file = None
-            if rows and columns:
-                import pandas as pd
-
+                # 直接执行查询，不再预先 EXPLAIN（否则 SQL 会被解析和规划两次）
                 try:
-                    df = pd.DataFrame(rows, columns=columns)
-                    result_file = generate_unique_filename(session_dir, "sql_result_", ".parquet")
-                    df.to_parquet(session_dir / result_file, index=False)
-                    logger.info(f"SQL result saved to {result_file}")
-                except Exception as e:
-                    logger.warning(f"Failed to save SQL result: {e}")
+                    # file_search_path 不作用于写入，相对路径的写入目标改写到会话目录下
+                    result = conn.execute(resolve_sql_write_paths(request.sql, session_dir))
+                except duckdb.ProgrammingError as sql_error:
+                    # 语法、绑定或 catalog 错误（解析/规划阶段），直接返回错误信息
+                    error_msg = str(sql_error)
+                    logger.warning(f"SQL syntax check failed: {error_msg}")
+                    return {"success": False, "error": error_msg}
+
+                # 以 Arrow RecordBatch 流式取回结果，边读边写 parquet 文件（供后续工具使用）
+                if result.description:
+                    reader = result.to_arrow_reader(SQL_RESULT_BATCH_ROWS)
+                    columns = reader.schema.names
+                    rows, total_rows, result_file = stream_query_result(reader, session_dir, request.max_rows)
+                    if result_file:
+                        logger.info(f"SQL result saved to {result_file}")
+                else:
+                    columns, rows, total_rows, result_file = [], [], 0, None
 
-            return {
-                "success": True,
-                "columns": columns,
-                "rows": [list(row) for row in rows],
-                "row_count": len(rows),
-                "result_file": result_file,  # 结果文件路径
-            }
-        finally:
-            os.chdir(original_cwd)
-            conn.close()
+                # 直接返回响应对象，跳过 FastAPI 对每个值逐一执行的 jsonable_encoder
+                return ORJSONResponse({
+                    "success": True,
+                    "columns": columns,
+                    "rows": rows,
+                    "row_count": total_rows,  # 结果总行数，可能大于 rows 的长度
+                    "has_more": total_rows > len(rows),
+                    "result_file": result_file,  # 结果文件路径
+                })
+            except Exception:
+                if not timed_out.is_set():
+                    raise
+                logger.warning(f"SQL execution timeout ({SQL_TIMEOUT}s)")
+                return {"success": False, "error": f"SQL execution timeout ({SQL_TIMEOUT}s)"}
+            finally:
+                interrupt_timer.cancel()
+                # SQL 可能创建或删除了 VIEW
+                view_columns_cache.invalidate(session_dir)
 
     except Exception as e:
-        import traceback
-
-        error_traceback = traceback.format_exc()
+        # 完整堆栈只记录在服务端日志中，响应只返回 DuckDB 的错误信息
         logger.exception("SQL execution failed")
-        return {"success": False, "error": f"{e!s}\n\n{error_traceback}"}
-
-
-# ==================== 数据分析 ====================
+        return {"success": False, "error": str(e)}
 
 
-def setup_duckdb_s3(conn) -> None:
+@app.post("/execute_sql", summary="Execute SQL query using DuckDB")
+async def execute_sql(
+    request: SqlRequest,
+    user_id: str = Query(..., description="User ID"),
+    thread_id: str = Query(..., description="Thread/Session ID"),
+):
     """
-    配置 DuckDB 以访问 MinIO (S3 兼容)。
-    
-    包含 INSTALL httpfs（用于首次未预加载的场景）。
-    如果扩展已预加载，使用 configure_s3_access() 即可。
+    使用会话的 DuckDB 文件执行 SQL 查询。
+
+    数据通过会话初始化时创建的 VIEWs 访问，AI 可以直接查询这些 VIEWs。
+    查询在工作线程中执行，不阻塞事件循环。
     """
-    # 设置扩展目录到可写路径
-    extensions_dir = SANDBOX_ROOT / "duckdb_extensions"
-    extensions_dir.mkdir(parents=True, exist_ok=True)
-    conn.execute(f"SET extension_directory='{extensions_dir}';")
-    
-    conn.execute("INSTALL httpfs;")
-    configure_s3_access(conn)
+    return await asyncio.to_thread(run_sql_query, request, user_id, thread_id)
 
 
-def get_db_connection_string(ds: DataSourceInfo) -> str:
-    """构建数据库连接字符串"""
-    if ds.db_type == "postgresql":
-        return f"postgresql://{ds.username}:{ds.password}@{ds.host}:{ds.port}/{ds.database}"
-    elif ds.db_type == "mysql":
-        return f"mysql://{ds.username}:{ds.password}@{ds.host}:{ds.port}/{ds.database}"
-    else:
-        raise ValueError(f"Unsupported database type: {ds.db_type}")
+# ==================== 数据分析 ====================
 
 
 def analyze_data_with_duckdb(conn, table_or_view: str = "data_preview") -> dict[str, Any]:
-    """使用 DuckDB 分析数据，返回统计结果"""
-    row_count = conn.execute(f"SELECT COUNT(*) FROM {table_or_view}").fetchone()[0]
-    columns_meta = conn.execute(f"PRAGMA table_info('{table_or_view}')").fetchall()
+    """
+    使用 DuckDB 分析数据，返回统计结果
 
-    numeric_types = {
-        "TINYINT", "SMALLINT", "INTEGER", "BIGINT", "HUGEINT",
-        "REAL", "DOUBLE", "FLOAT", "DECIMAL", "NUMERIC",
-    }
+    Args:
+        conn: DuckDB 连接
+        table_or_view: 表或 VIEW 名称（未转义，内部统一加引号）
+    """
+    relation = quote_identifier(table_or_view)
+    columns_meta = conn.execute("SELECT * FROM pragma_table_info(?)", [relation]).fetchall()
+
+    # 预先判定每列是否为数值类型（去掉 DECIMAL(18,2) 等类型的精度参数后比较）
+    numeric_mask = [col_type.partition("(")[0].upper() in NUMERIC_TYPES for _, _, col_type, *_ in columns_meta]
+
+    # 所有列的非空计数与数值统计合并为一次扫描，避免每列各扫描两遍
+    select_items = ["COUNT(*)"]
+    for (_, col_name, _, *_), is_numeric in zip(columns_meta, numeric_mask, strict=True):
+        column = quote_identifier(col_name)
+        select_items.append(f"COUNT({column})")
+        if is_numeric:
+            value = f"CAST({column} AS DOUBLE)"
+            select_items.extend([
+                f"AVG({value})",
+                f"STDDEV_POP({value})",
+                f"MIN({value})",
+                f"MAX({value})",
+                f"MEDIAN({value})",
+            ])
+    stats = iter(conn.execute(f"SELECT {', '.join(select_items)} FROM {relation}").fetchone())
+    row_count = next(stats)
 
     analysis_columns = []
     missing_values = {}
 
-    for _, col_name, col_type, *_ in columns_meta:
-        # 缺失值统计
-        null_count = conn.execute(
-            f'SELECT COUNT(*) FROM {table_or_view} WHERE "{col_name}" IS NULL'
-        ).fetchone()[0]
+    for (_, col_name, col_type, *_), is_numeric in zip(columns_meta, numeric_mask, strict=True):
+        non_null_count = next(stats)
+        null_count = row_count - non_null_count
 
         col_info: dict[str, Any] = {
             "name": col_name,
             "dtype": col_type,
-            "non_null_count": int(row_count - null_count),
-            "null_count": int(null_count),
+            "non_null_count": non_null_count,
+            "null_count": null_count,
         }
 
         # 数值列统计
-        if col_type.upper() in numeric_types and (row_count - null_count) > 0:
-            stats_row = conn.execute(
-                f'''
-                SELECT
-                    AVG(CAST("{col_name}" AS DOUBLE)) AS mean,
-                    STDDEV_POP(CAST("{col_name}" AS DOUBLE)) AS std,
-                    MIN(CAST("{col_name}" AS DOUBLE)) AS min,
-                    MAX(CAST("{col_name}" AS DOUBLE)) AS max,
-                    MEDIAN(CAST("{col_name}" AS DOUBLE)) AS median
-                FROM {table_or_view}
-                WHERE "{col_name}" IS NOT NULL
-                '''
-            ).fetchone()
-
-            col_info["stats"] = {
-                "mean": float(stats_row[0]) if stats_row[0] is not None else None,
-                "std": float(stats_row[1]) if stats_row[1] is not None else None,
-                "min": float(stats_row[2]) if stats_row[2] is not None else None,
-                "max": float(stats_row[3]) if stats_row[3] is not None else None,
-                "median": float(stats_row[4]) if stats_row[4] is not None else None,
-            }
+        if is_numeric:
+            mean, std, min_value, max_value, median = (next(stats) for _ in range(5))
+            if non_null_count > 0:
+                col_info["stats"] = {
+                    "mean": mean,
+                    "std": std,
+                    "min": min_value,
+                    "max": max_value,
+                    "median": median,
+                }
 
         analysis_columns.append(col_info)
-        missing_values[col_name] = int(null_count)
+        missing_values[col_name] = null_count
 
     return {
-        "row_count": int(row_count),
+        "row_count": row_count,
         "column_count": len(columns_meta),
         "columns": analysis_columns,
         "missing_values": missing_values,
     }
 
 
-def setup_duckdb_extensions_dir(conn) -> None:
-    """设置 DuckDB 扩展目录到可写路径"""
-    extensions_dir = SANDBOX_ROOT / "duckdb_extensions"
-    extensions_dir.mkdir(parents=True, exist_ok=True)
-    conn.execute(f"SET extension_directory='{extensions_dir}';")
+def analyze_session_file(file_path: Path, file_name: str) -> dict[str, Any]:
+    """
+    分析单个会话文件（同步执行，通过 asyncio.to_thread 调用）。
+
+    使用绝对路径读取文件，不切换工作目录，多个线程可安全并发执行。
+    """
+    conn = duckdb_manager.get_connection()
+    try:
+        # 根据文件类型选择读取方式
+        file_ext = file_path.suffix.lower()
+        source = quote_literal(str(file_path))
+
+        if file_ext == ".parquet":
+            conn.execute(f"CREATE OR REPLACE TEMP VIEW data_preview AS SELECT * FROM {source}")
+        elif file_ext == ".csv":
+            conn.execute(f"CREATE OR REPLACE TEMP VIEW data_preview AS SELECT * FROM read_csv_auto({source}, header=True)")
+        elif file_ext == ".json":
+            conn.execute(f"CREATE OR REPLACE TEMP VIEW data_preview AS SELECT * FROM read_json_auto({source})")
+        else:
+            return {"success": False, "error": f"Unsupported file type: {file_ext}"}
+
+        analysis = analyze_data_with_duckdb(conn, "data_preview")
+        analysis["file_name"] = file_name
+
+        return {"success": True, "analysis": analysis}
+    finally:
+        conn.close()
+
+
+def analyze_session_view(conn, view_name: str) -> dict[str, Any]:
+    """
+    在独立游标上分析单个 VIEW（在线程池中执行），失败时返回错误信息。
+    """
+    cursor = conn.cursor()
+    try:
+        analysis = analyze_data_with_duckdb(cursor, view_name)
+        analysis["view_name"] = view_name
+        return analysis
+    except Exception as e:
+        logger.warning(f"Failed to analyze view {view_name}: {e}")
+        return {
+            "view_name": view_name,
+            "error": str(e),
+        }
+    finally:
+        cursor.close()
+
+
+def analyze_session_views(duckdb_path: Path, view_names: list[str] | None) -> dict[str, Any]:
+    """
+    分析会话 DuckDB 中的 VIEW（同步执行，通过 asyncio.to_thread 调用）。
+
+    Args:
+        duckdb_path: 会话 DuckDB 文件路径
+        view_names: 要分析的 VIEW 名称列表，为空则分析所有 VIEW
+    """
+    with session_connections.cursor(duckdb_path) as conn:
+        # 获取要分析的 VIEW 列表
+        if not view_names:
+            # 查询所有 VIEW
+            views_result = conn.execute(
+                "SELECT table_name FROM information_schema.tables "
+                "WHERE table_type = 'VIEW' AND table_catalog = current_database() AND table_schema = current_schema() "
+                "ORDER BY table_name"
+            ).fetchall()
+            view_names = [row[0] for row in views_result]
+
+        if not view_names:
+            return {
+                "success": True,
+                "analysis": {
+                    "views": [],
+                    "message": "No VIEWs found in session DuckDB",
+                },
+            }
+
+        # 并发分析每个 VIEW（外部数据源以网络 I/O 为主，各自使用独立游标）
+        views_analysis = list(inspect_executor.map(functools.partial(analyze_session_view, conn), view_names))
+
+        # 如果只有一个 VIEW，简化返回结构
+        if len(views_analysis) == 1:
+            result_analysis = views_analysis[0]
+        else:
+            result_analysis = {
+                "view_count": len(views_analysis),
+                "views": views_analysis,
+            }
+
+        return {"success": True, "analysis": result_analysis}
 
 
 @app.post("/quick_analysis", summary="Quick data analysis")
@@ -1146,59 +2347,26 @@ async def quick_analysis(
     
     1. 分析会话文件：指定 file_name 参数
     2. 分析数据源 VIEW：指定 view_names 或留空分析所有 VIEW
-    """
-    import duckdb
-    import os
 
+    DuckDB 查询在工作线程中执行，不阻塞事件循环；分析结果直接以 ORJSONResponse 返回。
+    """
     session_dir = get_session_dir(user_id, thread_id)
 
     # ===== 模式 1：分析会话文件 =====
     if request.file_name:
-        file_path = session_dir / request.file_name
-
-        # 安全检查：防止路径穿越
-        try:
-            file_path.resolve().relative_to(session_dir.resolve())
-        except ValueError:
+        # 安全检查：防止路径穿越（含经由符号链接的穿越）
+        full_path = resolve_session_path(user_id, thread_id, request.file_name)
+        if full_path is None:
             return {"success": False, "error": "Invalid file path: path traversal detected"}
 
-        if not file_path.exists():
+        if not os.path.exists(full_path):
             return {"success": False, "error": f"File not found: {request.file_name}"}
 
-        conn = None
         try:
-            conn = duckdb.connect(":memory:")
-            extensions_dir = SANDBOX_ROOT / "duckdb_extensions"
-            conn.execute(f"SET extension_directory='{extensions_dir}';")
-
-            # 根据文件类型选择读取方式
-            file_ext = file_path.suffix.lower()
-            original_cwd = os.getcwd()
-            os.chdir(session_dir)
-
-            try:
-                if file_ext == ".parquet":
-                    conn.execute(f"CREATE OR REPLACE TEMP VIEW data_preview AS SELECT * FROM '{request.file_name}'")
-                elif file_ext == ".csv":
-                    conn.execute(f"CREATE OR REPLACE TEMP VIEW data_preview AS SELECT * FROM read_csv_auto('{request.file_name}', header=True)")
-                elif file_ext == ".json":
-                    conn.execute(f"CREATE OR REPLACE TEMP VIEW data_preview AS SELECT * FROM read_json_auto('{request.file_name}')")
-                else:
-                    return {"success": False, "error": f"Unsupported file type: {file_ext}"}
-
-                analysis = analyze_data_with_duckdb(conn, "data_preview")
-                analysis["file_name"] = request.file_name
-
-                return {"success": True, "analysis": analysis}
-            finally:
-                os.chdir(original_cwd)
-
+            return ORJSONResponse(await asyncio.to_thread(analyze_session_file, Path(full_path), request.file_name))
         except Exception as e:
             logger.exception(f"Failed to analyze file {request.file_name}")
             return {"success": False, "error": str(e)}
-        finally:
-            if conn:
-                conn.close()
 
     # ===== 模式 2：分析数据源 VIEW =====
     duckdb_path = session_dir / "session.duckdb"
@@ -1209,69 +2377,60 @@ async def quick_analysis(
             "error": "Session DuckDB not initialized. Please create a session with data source first.",
         }
 
-    conn = None
     try:
-        conn = duckdb.connect(str(duckdb_path), read_only=True)
+        return ORJSONResponse(await asyncio.to_thread(analyze_session_views, duckdb_path, request.view_names))
+    except Exception as e:
+        logger.exception("Quick analysis failed")
+        return {"success": False, "error": str(e)}
 
-        # 设置扩展目录
-        extensions_dir = SANDBOX_ROOT / "duckdb_extensions"
-        conn.execute(f"SET extension_directory='{extensions_dir}';")
 
-        # 配置 S3 访问（VIEW 可能引用 S3 URL）
-        configure_s3_access(conn)
+# ==================== 图表生成 ====================
 
-        # 获取要分析的 VIEW 列表
-        if request.view_names:
-            view_names = request.view_names
-        else:
-            # 查询所有 VIEW
-            views_result = conn.execute(
-                "SELECT table_name FROM information_schema.tables WHERE table_type = 'VIEW'"
-            ).fetchall()
-            view_names = [row[0] for row in views_result]
 
-        if not view_names:
-            return {
-                "success": True,
-                "analysis": {
-                    "views": [],
-                    "message": "No VIEWs found in session DuckDB",
-                },
-            }
+def run_chart_code(code_bytes: bytes, session_dir: str, result_conn) -> None:
+    """
+    在子进程中执行图表代码，并通过管道返回结果。
 
-        # 分析每个 VIEW
-        views_analysis = []
-        for view_name in view_names:
-            try:
-                analysis = analyze_data_with_duckdb(conn, f'"{view_name}"')
-                analysis["view_name"] = view_name
-                views_analysis.append(analysis)
-            except Exception as e:
-                logger.warning(f"Failed to analyze view {view_name}: {e}")
-                views_analysis.append({
-                    "view_name": view_name,
-                    "error": str(e),
-                })
+    Args:
+        code_bytes: 父进程编译并 marshal 序列化的 code object
+        session_dir: 会话目录，作为子进程的工作目录
+        result_conn: 用于发送结果的管道端
+    """
+    exec_globals = prepare_user_code_env(session_dir)
 
-        # 如果只有一个 VIEW，简化返回结构
-        if len(views_analysis) == 1:
-            result_analysis = views_analysis[0]
+    # 捕获输出
+    stdout_buffer = io.StringIO()
+    stderr_buffer = io.StringIO()
+
+    try:
+        with redirect_stdout(stdout_buffer), redirect_stderr(stderr_buffer):
+            exec(marshal.loads(code_bytes), exec_globals)
+
+        # 检查是否创建了 fig 变量
+        fig = exec_globals.get("fig")
+        if fig is None:
+            result = {
+                "success": False,
+                "error": "代码执行成功，但未找到 'fig' 变量。请确保代码创建了名为 'fig' 的 Plotly figure 对象。",
+                "output": stdout_buffer.getvalue(),
+            }
         else:
-            result_analysis = {
-                "view_count": len(views_analysis),
-                "views": views_analysis,
+            # 同时保存为 JSON 以便前端渲染（orjson 引擎直接序列化 numpy 数组，比默认的 json 编码器快得多）
+            result = {
+                "success": True,
+                "chart_json": fig.to_json(engine="orjson"),
+                "output": stdout_buffer.getvalue(),
             }
 
-        return {"success": True, "analysis": result_analysis}
-
     except Exception as e:
-        logger.exception("Quick analysis failed")
-        return {"success": False, "error": str(e)}
-    finally:
-        if conn:
-            conn.close()
+        result = {
+            "success": False,
+            "output": stdout_buffer.getvalue(),
+            "error": format_user_code_error(e),
+        }
 
-# ==================== 图表生成 ====================
+    result_conn.send(result)
+    result_conn.close()
 
 
 @app.post("/generate_chart", summary="Generate Plotly chart")
@@ -1292,56 +2451,8 @@ async def generate_chart(
     df = pd.DataFrame({'x': [1,2,3], 'y': [4,5,6]})
     fig = px.bar(df, x='x', y='y', title='示例图表')
     ```
+
+    代码在独立子进程中以会话目录为工作目录执行，不影响服务进程的状态。
     """
     session_dir = ensure_session_dir(user_id, thread_id)
-
-    # 捕获输出
-    stdout_buffer = io.StringIO()
-    stderr_buffer = io.StringIO()
-
-    # 准备执行环境
-    exec_globals = {
-        "__builtins__": __builtins__,
-        "__name__": "__main__",
-        "WORK_DIR": session_dir,
-    }
-
-    # 切换到会话目录
-    original_cwd = os.getcwd()
-    original_path = sys.path.copy()
-
-    try:
-        os.chdir(session_dir)
-        sys.path.insert(0, str(session_dir))
-
-        with redirect_stdout(stdout_buffer), redirect_stderr(stderr_buffer):
-            exec(request.code, exec_globals)
-
-        # 检查是否创建了 fig 变量
-        fig = exec_globals.get("fig")
-        if fig is None:
-            return {
-                "success": False,
-                "error": "代码执行成功，但未找到 'fig' 变量。请确保代码创建了名为 'fig' 的 Plotly figure 对象。",
-                "output": stdout_buffer.getvalue(),
-            }
-
-        # 同时保存为 JSON 以便前端渲染
-        chart_json = fig.to_json()
-
-        return {
-            "success": True,
-            "chart_json": chart_json,
-            "output": stdout_buffer.getvalue(),
-        }
-
-    except Exception as e:
-        error_traceback = traceback.format_exc()
-        return {
-            "success": False,
-            "output": stdout_buffer.getvalue(),
-            "error": f"{e!s}\n\n{error_traceback}",
-        }
-    finally:
-        os.chdir(original_cwd)
-        sys.path = original_path
+    return await run_user_code_in_process(run_chart_code, request.code, session_dir)
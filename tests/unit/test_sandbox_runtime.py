@@ -0,0 +1,93 @@
+"""
+沙盒运行时单元测试
+
+直接测试 sandbox_runtime/main.py 中的纯函数：
+- 数据库连接字符串拼接
+- SQL 结果预览的 JSON 序列化
+- SQL 写入目标的相对路径改写
+"""
+
+import importlib.util
+from pathlib import Path
+from types import ModuleType
+
+import duckdb
+import orjson
+import pytest
+
+SANDBOX_MAIN = Path(__file__).resolve().parents[2] / "sandbox_runtime" / "main.py"
+
+
+@pytest.fixture(scope="module")
+def sandbox() -> ModuleType:
+    """按文件路径加载沙盒运行时模块（sandbox_runtime 不是包）"""
+    spec = importlib.util.spec_from_file_location("sandbox_runtime_main", SANDBOX_MAIN)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestBuildConninfo:
+    """连接字符串拼接测试"""
+
+    def test_postgresql_plain_values(self, sandbox: ModuleType):
+        """测试 PostgreSQL 普通值不加引号，None 参数省略"""
+        conninfo = sandbox.build_conninfo("postgresql", host="db", port=5432, dbname="sales", user="u", password=None)
+        assert conninfo == "host=db port=5432 dbname=sales user=u"
+
+    def test_postgresql_quotes_special_values(self, sandbox: ModuleType):
+        """测试 PostgreSQL 使用 libpq 单引号格式转义特殊字符"""
+        conninfo = sandbox.build_conninfo("postgresql", user="", password="p a'ss\\w\"d")
+        assert conninfo == "user='' password='p a\\'ss\\\\w\"d'"
+
+    def test_mysql_plain_values(self, sandbox: ModuleType):
+        """测试 MySQL 普通值不加引号"""
+        conninfo = sandbox.build_conninfo("mysql", host="db", port=3306, database="sales", user="u")
+        assert conninfo == "host=db port=3306 database=sales user=u"
+
+    def test_mysql_quotes_special_values(self, sandbox: ModuleType):
+        """测试 MySQL 使用双引号包裹，只转义反斜杠和双引号"""
+        conninfo = sandbox.build_conninfo("mysql", user="", password="p a'ss\\w\"d")
+        assert conninfo == "user=\"\" password=\"p a'ss\\\\w\\\"d\""
+
+
+class TestSqlResultPreview:
+    """SQL 结果预览序列化测试"""
+
+    def test_interval_and_map_shapes(self, sandbox: ModuleType, tmp_path: Path):
+        """测试 INTERVAL 输出为总秒数、MAP 输出为对象，与 DuckDB fetchall() 的结果一致"""
+        conn = duckdb.connect()
+        reader = conn.execute(
+            "SELECT INTERVAL 90 MINUTE AS iv, INTERVAL '1 month 2 days' AS iv2, MAP {'a': 1, 'b': 2} AS m"
+        ).to_arrow_reader(100)
+
+        rows, total_rows, result_file = sandbox.stream_query_result(reader, tmp_path, 10)
+        body = orjson.loads(sandbox.ORJSONResponse({"rows": rows}).body)
+
+        assert total_rows == 1
+        assert body["rows"] == [[5400.0, 32 * 86400.0, {"a": 1, "b": 2}]]
+        assert result_file is not None and (tmp_path / result_file).exists()
+
+
+class TestResolveSqlWritePaths:
+    """SQL 写入路径改写测试"""
+
+    def test_relative_targets_resolved(self, sandbox: ModuleType):
+        """测试 COPY/EXPORT/ATTACH 的相对路径改写到会话目录下"""
+        sql = "COPY (SELECT 'TO ''x''' AS a) TO 'out.csv' (HEADER); EXPORT DATABASE 'exp'; ATTACH 'it''s.duckdb' AS d"
+        assert sandbox.resolve_sql_write_paths(sql, Path("/s")) == (
+            "COPY (SELECT 'TO ''x''' AS a) TO '/s/out.csv' (HEADER); "
+            "EXPORT DATABASE '/s/exp'; ATTACH '/s/it''s.duckdb' AS d"
+        )
+
+    def test_other_targets_unchanged(self, sandbox: ModuleType):
+        """测试读取、绝对路径、URL 和连接字符串保持不变"""
+        for sql in [
+            "SELECT * FROM 'sql_result_x.parquet'",
+            "COPY t FROM 'in.csv'",
+            "COPY t TO '/abs/out.csv'",
+            "COPY t TO 's3://bucket/out.csv'",
+            "ATTACH 'dbname=sales' AS pg (TYPE POSTGRES)",
+        ]:
+            assert sandbox.resolve_sql_write_paths(sql, Path("/s")) == sql